@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Batch Augmentation
+
+Augmentations are applied to whole (N, H, W, C) batches, after collation
+and on the training device, rather than per sample in the DataLoader
+workers. Every random draw comes from one seeded generator, so a run can be
+reproduced.
+"""
+import torch
+
+
+class BatchAugment:
+    """Random flips, rotations and brightness shifts of training batches
+
+    Usage::
+
+        opts = {k: v for k, v in conf.augment_opts.items() if k != "enabled"}
+        augment = BatchAugment(**opts)
+        x, y = augment(x, y)
+    """
+
+    def __init__(self, hflip=0.5, vflip=0.5, rot90=True, brightness=0.0,
+                 brightness_channels=None, seed=0):
+        """Initialize augmentation.
+
+        Args:
+            hflip(float): The probability of flipping a sample left to right
+            vflip(float): The probability of flipping a sample upside down
+            rot90(bool): Whether to rotate samples by a random multiple of 90
+              degrees. Non square samples are only rotated by 180 degrees.
+            brightness(float): The maximum shift of a channel, drawn uniformly
+              per sample and channel. Images are normalized, so this is in
+              units of the channel's standard deviation.
+            brightness_channels([int]): The image channels to shift, e.g., the
+              spectral bands but not the elevation or slope. None shifts all
+              channels.
+            seed(int): The seed of the random generator
+        """
+        self.hflip = hflip
+        self.vflip = vflip
+        self.rot90 = rot90
+        self.brightness = brightness
+        self.brightness_channels = brightness_channels
+        self.generator = torch.Generator().manual_seed(seed)
+
+    def __call__(self, x, y):
+        """Augment a batch, in place
+
+        Args:
+            x(torch.Tensor): (N, H, W, C) images
+            y(torch.Tensor): (N, H, W, K) labels, transformed alongside x
+
+        Return:
+            The augmented x and y
+        """
+        n = x.shape[0]
+        # draw on the cpu, so the sequence does not depend on the device
+        hflip = torch.rand(n, generator=self.generator) < self.hflip
+        vflip = torch.rand(n, generator=self.generator) < self.vflip
+        k = torch.randint(0, 4, (n,), generator=self.generator)
+        if not self.rot90:
+            k.zero_()
+        elif x.shape[1] != x.shape[2]:
+            k = 2 * (k % 2)
+
+        # rot90^k . vflip^v . hflip^h = rot90^(k + 2v) . hflip^(h xor v), so
+        # each sample gets one of 8 transforms, applied a group at a time
+        flip = hflip ^ vflip
+        k = (k + 2 * vflip.long()) % 4
+        for (f, rotation), (dims, transpose) in DIHEDRAL.items():
+            ix = ((flip == f) & (k == rotation)).nonzero().squeeze(1).to(x.device)
+            if len(ix) == 0:
+                continue
+            for z in [x, y]:
+                t = z[ix]
+                if dims:
+                    t = t.flip(dims)
+                z[ix] = t.transpose(1, 2) if transpose else t
+
+        if self.brightness > 0:
+            shift = torch.zeros(n, x.shape[-1])
+            channels = self.brightness_channels
+            if channels is None:
+                channels = list(range(x.shape[-1]))
+            shift[:, channels] = (2 * torch.rand(n, len(channels), generator=self.generator) - 1) * self.brightness
+            x += shift.to(device=x.device, dtype=x.dtype)[:, None, None, :]
+
+        return x, y
+
+
+# (hflip, rot90 k) -> (dimensions to flip, whether to swap H and W), for
+# (N, H, W, C) batches
+DIHEDRAL = {
+    (True, 0): ((2,), False),
+    (True, 1): ((), True),
+    (True, 2): ((1,), False),
+    (True, 3): ((1, 2), True),
+    (False, 1): ((2,), True),
+    (False, 2): ((1, 2), False),
+    (False, 3): ((1,), True),
+}
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+"""
+Cache of Postprocessed Slices
+
+Training reads slices after they pass through the process_funs of a
+postprocessing configuration. Rather than postprocessing the slices of a
+split in place, the TensorCache stores the postprocessed slices in a
+directory named after a hash of
+
+* the process_funs, as resolved from the configuration,
+* the contents of the statistics files they use, and
+* the names, sizes and modification times of the raw slices.
+
+so that a configuration that has already been used is served directly, and
+a new one (e.g., another channel experiment) only recomputes the
+postprocessed slices, in parallel. Each entry is a sharded directory (see
+storage.py) with a manifest.json, and the least recently used entries are
+evicted once the cache grows beyond its byte budget.
+
+Several jobs can share a cache directory. Each process that gets an entry
+holds a lease on it, a file in .leases/<key>/ named after its host and pid,
+until it exits or calls release. Entries with a live lease are never
+evicted: a lease is live while its process runs, and leases of other hosts,
+whose processes cannot be checked, are live until they are removed. Removing
+an entry by hand while it is read, e.g. by the loaders of another job, makes
+that job fail.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import atexit
+import hashlib
+import json
+import os
+import shutil
+import socket
+import time
+import numpy as np
+from .data import GlacierDataset
+from .process_slices_funs import compile_process_funs
+from .storage import INDEX_SUFFIX, ShardWriter, load_slice
+
+ENTRY_MANIFEST = "manifest.json"
+LEASES_DIR = ".leases"
+
+
+def cache_key(folder_path, process_funs):
+    """Hash identifying the postprocessed slices of a directory
+
+    Args:
+        folder_path(str): A directory of raw slices, in any of the layouts
+          read by GlacierDataset
+        process_funs: Specified process functions
+
+    Return:
+        A hexadecimal sha256 digest
+    """
+    h = hashlib.sha256()
+    # the order of the functions changes their output, so it is part of the key
+    h.update(json.dumps(process_funs).encode())
+    for fun_args in process_funs.values():
+        if "stats_path" in fun_args:
+            h.update(Path(fun_args["stats_path"]).read_bytes())
+
+    dataset = GlacierDataset(folder_path)
+    sources = sorted(dataset.img_files + dataset.mask_files)
+    if dataset.shards is not None:
+        h.update("\n".join(sources).encode())
+        sources = sorted(Path(folder_path).glob(f"*{INDEX_SUFFIX}"))
+    for path in sources:
+        stat = os.stat(path)
+        h.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return h.hexdigest()
+
+
+def process_chunk(img_paths, mask_paths, process_funs, out_dir, prefix, shard_size=1024):
+    """Postprocess a list of slices into shards
+
+    Args:
+        img_paths([str]): Paths to the raw image slices
+        mask_paths([str]): Paths to the raw mask slices
+        process_funs: Specified process functions
+        out_dir(str): The directory in which to write the shards
+        prefix(str): The basename of the shards
+        shard_size(int): The number of slices per shard
+
+    Return:
+        The number of bytes written
+    """
+    pipeline = compile_process_funs(process_funs)
+    n_bytes = 0
+    with ShardWriter(out_dir, prefix, shard_size) as writer:
+        for img_path, mask_path in zip(img_paths, mask_paths):
+            img = load_slice(img_path, channels=pipeline.input_channels)
+            img, mask = pipeline(img, load_slice(mask_path), selected=True)
+            img = img.astype(np.float32, copy=False)
+            writer.write(Path(img_path).name, img, Path(mask_path).name, mask)
+            n_bytes += img.nbytes + mask.nbytes
+    return n_bytes
+
+
+def pid_running(pid):
+    """Whether a process of this host is running"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class TensorCache:
+    """Content addressed cache of postprocessed slices
+
+    Usage::
+
+        cache = TensorCache("/datadrive/glaciers/cache", budget=200e9)
+        train_dir = cache.get(processed_dir / "train", pconf.process_funs)
+    """
+
+    def __init__(self, cache_dir, budget=None):
+        """Initialize cache.
+
+        Args:
+            cache_dir(str): The directory holding the cache entries
+            budget(float): The maximum number of bytes of all the entries. None
+              means that entries are never evicted.
+        """
+        self.cache_dir = Path(cache_dir)
+        self.budget = budget
+        self.lease_name = f"{socket.gethostname()}.{os.getpid()}"
+        self.leased = set()
+        os.makedirs(self.cache_dir / LEASES_DIR, exist_ok=True)
+        atexit.register(self.release)
+
+    def get(self, folder_path, process_funs, n_workers=None, chunk_size=256, shard_size=1024):
+        """Get the directory of postprocessed slices, computing it if needed
+
+        Args:
+            folder_path(str): A directory of raw slices
+            process_funs: Specified process functions
+            n_workers(int): The number of worker processes on a miss. Defaults
+              to the number of CPUs.
+            chunk_size(int): The number of slices per worker task
+            shard_size(int): The number of slices per shard
+
+        Return:
+            The path of a sharded directory, readable by GlacierDataset. This
+            process holds a lease on it, so that it is not evicted by any
+            cache on the same directory until release, even if that keeps the
+            cache over its budget.
+        """
+        key = cache_key(folder_path, process_funs)
+        self.lease(key)
+        entry = self.cache_dir / key
+        if (entry / ENTRY_MANIFEST).exists():
+            os.utime(entry / ENTRY_MANIFEST)
+            return entry
+
+        dataset = GlacierDataset(folder_path)
+        tmp_dir = self.cache_dir / f".{key}.{os.getpid()}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        start = time.time()
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [
+                executor.submit(
+                    process_chunk,
+                    dataset.img_files[i:i + chunk_size],
+                    dataset.mask_files[i:i + chunk_size],
+                    json.loads(json.dumps(process_funs)),
+                    tmp_dir,
+                    f"chunk_{i // chunk_size:05}",
+                    shard_size
+                )
+                for i in range(0, len(dataset), chunk_size)
+            ]
+            n_bytes = sum(f.result() for f in futures)
+
+        manifest = {
+            "key": key,
+            "source": str(Path(folder_path).resolve()),
+            "process_funs": process_funs,
+            "n_slices": len(dataset),
+            "bytes": n_bytes,
+            "seconds": time.time() - start,
+        }
+        with open(tmp_dir / ENTRY_MANIFEST, "w") as f:
+            json.dump(manifest, f)
+
+        try:
+            os.rename(tmp_dir, entry)
+        except OSError:
+            # another process completed the same entry first
+            shutil.rmtree(tmp_dir)
+
+        self.evict()
+        return entry
+
+    def lease(self, key):
+        """Mark an entry as in use by this process"""
+        lease_dir = self.cache_dir / LEASES_DIR / key
+        os.makedirs(lease_dir, exist_ok=True)
+        (lease_dir / self.lease_name).touch()
+        self.leased.add(key)
+
+    def release(self, key=None):
+        """Release the lease of this process on an entry, or on all of them
+
+        Args:
+            key(str): The key of the entry. None releases every entry this
+              cache has leased, as happens when the process exits.
+        """
+        keys = list(self.leased) if key is None else [key]
+        for k in keys:
+            try:
+                (self.cache_dir / LEASES_DIR / k / self.lease_name).unlink()
+            except FileNotFoundError:
+                pass
+            self.leased.discard(k)
+
+    def in_use(self, key):
+        """Whether any process holds a live lease on an entry
+
+        Leases of processes of this host that no longer run are removed.
+        """
+        lease_dir = self.cache_dir / LEASES_DIR / key
+        if not lease_dir.exists():
+            return False
+
+        host = socket.gethostname()
+        live = False
+        for path in lease_dir.iterdir():
+            lease_host, _, pid = path.name.rpartition(".")
+            if lease_host != host or pid_running(int(pid)):
+                live = True
+            else:
+                path.unlink(missing_ok=True)
+        return live
+
+    def entries(self):
+        """The manifests of the complete entries, least recently used first"""
+        manifests = []
+        for path in self.cache_dir.glob(f"*/{ENTRY_MANIFEST}"):
+            if path.parent.name.startswith("."):
+                continue
+            manifest = json.load(open(path, "r"))
+            manifest["last_used"] = path.stat().st_mtime
+            manifests.append(manifest)
+        return sorted(manifests, key=lambda m: m["last_used"])
+
+    def evict(self, keep=()):
+        """Remove least recently used entries until the cache fits its budget
+
+        Args:
+            keep([str]): Keys of entries never to evict, besides those with a
+              live lease
+
+        Return:
+            The keys of the evicted entries
+        """
+        if self.budget is None:
+            return []
+
+        entries = self.entries()
+        total = sum(m["bytes"] for m in entries)
+        evicted = []
+        for manifest in entries:
+            if total <= self.budget:
+                break
+            if manifest["key"] in keep or self.in_use(manifest["key"]):
+                continue
+            shutil.rmtree(self.cache_dir / manifest["key"])
+            try:
+                os.rmdir(self.cache_dir / LEASES_DIR / manifest["key"])
+            except OSError:
+                pass
+            total -= manifest["bytes"]
+            evicted.append(manifest["key"])
+        return evicted
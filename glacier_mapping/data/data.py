@@ -2,59 +2,232 @@
 Custom Dataset for Training
 """
 #!/usr/bin/env python
+from multiprocessing import shared_memory
+import multiprocessing
 import glob
 import os
-from torch.utils.data import Dataset, DataLoader
+import random
+import time
+from torch.utils.data import Dataset, DataLoader, Sampler
 import numpy as np
 import torch
+from .storage import (
+    MANIFEST_NAME,
+    ShardReader,
+    decode_slice,
+    is_sharded,
+    read_encoding,
+    read_manifest,
+    read_slice,
+    select_channels,
+)
 
 def fetch_loaders(processed_dir, batch_size=32,
                   train_folder='train', dev_folder='dev', test_folder='',
-                  shuffle=True):
+                  shuffle=True, cache=None, process_funs=None, dataset_opts=None,
+                  loader_opts=None):
     """ Function to fetch dataLoaders for the Training / Validation
 
     Args:
         processed_dir(str): Directory with the processed data
         batch_size(int): The size of each batch during training. Defaults to 32.
+        cache(TensorCache): If given, the folders hold raw slices, which are
+          read from the cache after postprocessing with process_funs
+        process_funs: Specified process functions, used with cache
+        dataset_opts(dict): Keyword arguments for each GlacierDataset, e.g.,
+          mmap_mode. cache_bytes is the shared memory cache of the train
+          dataset only, and val_cache_bytes that of the val dataset, so the
+          two budgets add up. The test dataset is not cached.
+        loader_opts(dict): DataLoader settings: num_workers (train),
+          val_workers (val / test), pin_memory, persistent_workers,
+          prefetch_factor, and auto_tune, which replaces num_workers and
+          prefetch_factor by the fastest of the candidates measured by
+          tune_loader
 
     Return:
         Returns train and val dataloaders
 
     """
-    train_dataset = GlacierDataset(processed_dir / train_folder)
-    val_dataset = GlacierDataset(processed_dir / dev_folder)
+    def folder(name):
+        if cache is None:
+            return processed_dir / name
+        return cache.get(processed_dir / name, process_funs)
+
+    dataset_opts = dict(dataset_opts or {})
+    train_bytes = dataset_opts.pop("cache_bytes", 0)
+    val_bytes = dataset_opts.pop("val_cache_bytes", 0)
+    train_dataset = GlacierDataset(folder(train_folder), cache_bytes=train_bytes, **dataset_opts)
+    val_dataset = GlacierDataset(folder(dev_folder), cache_bytes=val_bytes, **dataset_opts)
+
+    # shuffle sharded data one shard at a time, to keep reads sequential
+    sampler = None
+    if shuffle and train_dataset.shards is not None:
+        sampler, shuffle = ShardSampler(train_dataset.shards), False
+
+    opts = {**DEFAULT_LOADER_OPTS, **(loader_opts or {})}
+    if opts["auto_tune"]:
+        best = tune_loader(train_dataset, batch_size, n_batches=opts["auto_tune_batches"])
+        print(f"auto_tune: num_workers={best['num_workers']}, "
+              f"prefetch_factor={best['prefetch_factor']}")
+        opts.update(best)
+
     loader = {
         "train": DataLoader(train_dataset, batch_size=batch_size,
-                            num_workers=8, shuffle=shuffle),
-        "val": DataLoader(val_dataset, batch_size=batch_size,
-                          num_workers=3, shuffle=False)}
+                            shuffle=shuffle, sampler=sampler,
+                            **loader_kwargs(opts["num_workers"], opts)),
+        "val": DataLoader(val_dataset, batch_size=batch_size, shuffle=False,
+                          **loader_kwargs(opts["val_workers"], opts))}
 
     if test_folder:
-        test_dataset = GlacierDataset(processed_dir / test_folder)
-        loader["test"] = DataLoader(test_dataset, batch_size=batch_size,
-                                    num_workers=3, shuffle=False)
+        test_dataset = GlacierDataset(folder(test_folder), **dataset_opts)
+        loader["test"] = DataLoader(test_dataset, batch_size=batch_size, shuffle=False,
+                                    **loader_kwargs(opts["val_workers"], opts))
 
     return loader
 
 
+DEFAULT_LOADER_OPTS = {
+    "num_workers": 8,
+    "val_workers": 3,
+    "pin_memory": False,
+    "persistent_workers": False,
+    "prefetch_factor": 2,
+    "auto_tune": False,
+    "auto_tune_batches": 20,
+}
+
+
+def loader_kwargs(num_workers, opts):
+    """DataLoader keyword arguments for a number of workers
+
+    Worker settings are only passed when there are workers, and memory is only
+    pinned when there is a GPU to copy to.
+    """
+    kwargs = {
+        "num_workers": num_workers,
+        "pin_memory": bool(opts["pin_memory"]) and torch.cuda.is_available(),
+    }
+    if num_workers > 0:
+        kwargs["persistent_workers"] = bool(opts["persistent_workers"])
+        kwargs["prefetch_factor"] = opts["prefetch_factor"]
+    return kwargs
+
+
+def tune_loader(dataset, batch_size, candidates=None, n_batches=20):
+    """Find the fastest DataLoader settings for a dataset on this machine
+
+    Each candidate loads n_batches shuffled batches, after a first batch that
+    absorbs the worker start up, and the one with the highest throughput wins.
+
+    Args:
+        dataset(Dataset): The dataset to load
+        batch_size(int): The size of each batch
+        candidates(list of dict): Settings with keys num_workers and
+          prefetch_factor. Defaults to 0 up to the number of CPUs workers, each
+          with prefetch factors 2 and 4.
+        n_batches(int): The number of batches to time per candidate
+
+    Return:
+        The fastest candidate, as a dict
+    """
+    if candidates is None:
+        n_cpus = os.cpu_count() or 1
+        workers = sorted({0} | {w for w in [2, 4, 8, 16] if w < n_cpus} | {n_cpus})
+        candidates = [{"num_workers": 0, "prefetch_factor": 2}] + [
+            {"num_workers": w, "prefetch_factor": p} for w in workers if w > 0 for p in [2, 4]
+        ]
+
+    timings = []
+    for candidate in candidates:
+        loader = DataLoader(
+            dataset, batch_size=batch_size, shuffle=True,
+            **loader_kwargs(candidate["num_workers"], {**DEFAULT_LOADER_OPTS, **candidate})
+        )
+        batches = iter(loader)
+        next(batches)
+        n_samples, start = 0, time.perf_counter()
+        for _, (x, _) in zip(range(n_batches), batches):
+            n_samples += len(x)
+        elapsed = time.perf_counter() - start
+        del batches
+        timings.append(n_samples / max(elapsed, 1e-9))
+        print(f"tune_loader: {candidate} {timings[-1]:.1f} samples/sec")
+
+    return candidates[int(np.argmax(timings))]
+
+
 class GlacierDataset(Dataset):
     """Custom Dataset for Glacier Data
 
     Indexing the i^th element returns the underlying image and the associated
-    binary mask
+    binary mask, or uint8 class index map. The slices can either be one .npy
+    file each, or packed into shards, in which case they are read as views of
+    the memory mapped shards. A folder with a manifest.csv reads the slices
+    listed in the manifest.
+    Slices stored with a compact encoding (see storage.py) are decoded, and
+    only the image channels in img_channels are read, which for channel major
+    slices avoids reading the other channels at all.
 
     """
 
-    def __init__(self, folder_path):
+    def __init__(self, folder_path, mmap_mode=None, cache_bytes=0, img_channels=None):
         """Initialize dataset.
 
         Args:
             folder_path(str): A path to data directory
+            mmap_mode(str): If given (e.g., "r"), the memory map mode with
+              which to open .npy slices, instead of loading them whole
+            cache_bytes(int): If positive, the size of a SharedSampleCache
+              keeping the most recently read slices in shared memory, across
+              DataLoader workers and epochs
+            img_channels([int]): If given, the image channels to read, e.g., the
+              img_channels of extract_channel in the process config
 
         """
+        self.mmap_mode = mmap_mode
+        self.img_channels = img_channels
+        self.cache = None
+        self.shards = None
+        if os.path.exists(os.path.join(folder_path, MANIFEST_NAME)):
+            self.img_files, self.mask_files = read_manifest(folder_path)
+        elif is_sharded(folder_path):
+            self.shards = ShardReader(folder_path)
+            self.img_files = [os.path.join(folder_path, s) for s in self.shards.img_names]
+            self.mask_files = [os.path.join(folder_path, s) for s in self.shards.mask_names]
+        else:
+            self.img_files = glob.glob(os.path.join(folder_path, '*img*'))
+            self.mask_files = [s.replace("img", "mask") for s in self.img_files]
+
+        # read once, rather than looked up for every sample
+        folders = set(map(os.path.dirname, self.img_files))
+        self.encodings = {folder: read_encoding(folder) for folder in folders}
+        self.readers = {}
+        if self.shards is None:
+            # manifests may list slices inside shards
+            self.readers = {folder: ShardReader(folder) for folder in folders if is_sharded(folder)}
 
-        self.img_files = glob.glob(os.path.join(folder_path, '*img*'))
-        self.mask_files = [s.replace("img", "mask") for s in self.img_files]
+        if cache_bytes > 0 and len(self.img_files) > 0:
+            self.cache = SharedSampleCache(cache_bytes, len(self), *self.read(0))
+
+    def read(self, index):
+        """Read the image and mask of a slice as stored, without caching or decoding"""
+        encoding = self.encoding(index)
+        if self.shards is not None:
+            img, mask = self.shards[index]
+            return select_channels(img, self.img_channels, encoding), mask
+        reader = self.readers.get(os.path.dirname(self.img_files[index]))
+        if reader is not None:
+            img = reader.load(os.path.basename(self.img_files[index]))
+            mask = reader.load(os.path.basename(self.mask_files[index]))
+            return select_channels(img, self.img_channels, encoding), mask
+        return (
+            read_slice(self.img_files[index], encoding, self.mmap_mode, self.img_channels),
+            read_slice(self.mask_files[index], encoding, self.mmap_mode)
+        )
+
+    def encoding(self, index):
+        """The encoding of the directory of a slice, see storage.make_encoding"""
+        return self.encodings[os.path.dirname(self.img_files[index])]
 
     def __getitem__(self, index):
 
@@ -67,12 +240,18 @@ class GlacierDataset(Dataset):
             data(x) and corresponding label(y)
         """
 
-        img_path = self.img_files[index]
-        mask_path = self.mask_files[index]
-        data = np.load(img_path)
-        label = np.load(mask_path)
+        sample = None if self.cache is None else self.cache.get(index)
+        if sample is None:
+            sample = self.read(index)
+            if self.cache is not None:
+                self.cache.put(index, *sample)
 
-        return torch.from_numpy(data).float(), torch.from_numpy(label).float()
+        encoding = self.encoding(index)
+        data = as_tensor(decode_slice(sample[0], encoding))
+        label = decode_slice(sample[1], encoding, "mask")
+        # class index maps (see class_index) stay uint8 until on the device
+        label = as_tensor(label, None if label.ndim == 2 else np.float32)
+        return data, label
 
     def __len__(self):
         """ Function to return the length of the dataset
@@ -83,3 +262,173 @@ class GlacierDataset(Dataset):
 
         """
         return len(self.img_files)
+
+
+def as_tensor(x, dtype=np.float32):
+    """Convert a slice to a tensor, copying only when needed
+
+    dtype None keeps the dtype of the slice, e.g., for class index maps.
+    """
+    x = np.asarray(x, dtype=dtype)
+    if not x.flags.writeable:
+        x = x.copy()
+    return torch.from_numpy(x)
+
+
+class ShardSampler(Sampler):
+    """Shuffle sharded slices while keeping reads local to one shard
+
+    Each epoch visits the shards in a random order, and the slices of each
+    shard in a random order, so consecutive reads stay in the same file.
+    """
+
+    def __init__(self, reader, seed=0):
+        self.reader = reader
+        self.seed = seed
+        self.epoch = 0
+
+    def __iter__(self):
+        rng = random.Random(self.seed + self.epoch)
+        self.epoch += 1
+
+        shards = {}
+        for position, shard in enumerate(self.reader.shard_ids()):
+            shards.setdefault(shard, []).append(position)
+
+        order = list(shards.values())
+        rng.shuffle(order)
+        for positions in order:
+            rng.shuffle(positions)
+            yield from positions
+
+    def __len__(self):
+        return len(self.reader)
+
+
+class SharedSampleCache:
+    """Least recently used cache of slices, in shared memory
+
+    The cache holds a fixed number of slots, each the size of one image and
+    mask, in one shared memory block. The slot table, use counters, and hit
+    statistics live in a second block, so that every DataLoader worker (and
+    the main process) sees the same cache, across epochs when workers are
+    restarted. Shared memory is usually backed by /dev/shm, which has to be
+    large enough for the budget.
+    """
+
+    def __init__(self, budget, n_samples, img, mask, mp_context=None):
+        """Initialize cache.
+
+        Args:
+            budget(int): The maximum number of bytes of slices to keep
+            n_samples(int): The number of slices in the dataset
+            img(np.array): An example image, giving the shape and dtype of all
+              the images
+            mask(np.array): An example mask
+            mp_context(str): The multiprocessing start method of the
+              DataLoader workers, if not the default one
+        """
+        self.specs = [(x.shape, x.dtype) for x in [img, mask]]
+        self.slot_bytes = img.nbytes + mask.nbytes
+        self.n_slots = int(min(budget // self.slot_bytes, n_samples))
+        self.n_samples = n_samples
+        self.lock = multiprocessing.get_context(mp_context).Lock()
+        self.owner_pid = os.getpid()
+
+        # table layout: slot of each sample, sample of each slot, last use of
+        # each slot, then the clock, hits, misses, and bytes served
+        table_len = n_samples + 2 * self.n_slots + 4
+        self.blocks = [
+            shared_memory.SharedMemory(create=True, size=max(self.n_slots * self.slot_bytes, 1)),
+            shared_memory.SharedMemory(create=True, size=8 * table_len),
+        ]
+        self._attach()
+        self.slot_of[:] = -1
+        self.sample_of[:] = -1
+        self.last_used[:] = 0
+        self.counters[:] = 0
+
+    def _attach(self):
+        data, table = self.blocks
+        table = np.ndarray((self.n_samples + 2 * self.n_slots + 4,), np.int64, table.buf)
+        self.slot_of = table[:self.n_samples]
+        self.sample_of = table[self.n_samples:self.n_samples + self.n_slots]
+        self.last_used = table[self.n_samples + self.n_slots:-4]
+        self.counters = table[-4:]
+        self.data = np.ndarray((self.n_slots, self.slot_bytes), np.uint8, data.buf)
+
+    def _views(self, slot):
+        (img_shape, img_dtype), (mask_shape, mask_dtype) = self.specs
+        img_bytes = int(np.prod(img_shape)) * img_dtype.itemsize
+        row = self.data[slot]
+        return (
+            row[:img_bytes].view(img_dtype).reshape(img_shape),
+            row[img_bytes:].view(mask_dtype).reshape(mask_shape)
+        )
+
+    def get(self, index):
+        """Copies of the cached image and mask, or None on a miss"""
+        with self.lock:
+            slot = self.slot_of[index]
+            if slot < 0:
+                self.counters[2] += 1
+                return None
+            self.counters[0] += 1
+            self.last_used[slot] = self.counters[0]
+            self.counters[1] += 1
+            self.counters[3] += self.slot_bytes
+            return tuple(np.array(x) for x in self._views(slot))
+
+    def put(self, index, img, mask):
+        """Cache an image and mask, evicting the least recently used slot"""
+        if self.n_slots == 0:
+            return
+        with self.lock:
+            if self.slot_of[index] >= 0:
+                return
+            slot = int(np.argmin(self.last_used))
+            if self.sample_of[slot] >= 0:
+                self.slot_of[self.sample_of[slot]] = -1
+            for view, x in zip(self._views(slot), [img, mask]):
+                view[...] = x
+            self.counters[0] += 1
+            self.last_used[slot] = self.counters[0]
+            self.sample_of[slot] = index
+            self.slot_of[index] = slot
+
+    def stats(self):
+        """Hit rate and bytes served from the cache, for logging"""
+        hits, misses = int(self.counters[1]), int(self.counters[2])
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / max(hits + misses, 1),
+            "bytes_served": int(self.counters[3]),
+            "slots_used": int(np.sum(self.sample_of >= 0)),
+        }
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in ["blocks", "slot_of", "sample_of", "last_used", "counters", "data"]:
+            del state[k]
+        state["names"] = [block.name for block in self.blocks]
+        return state
+
+    def __setstate__(self, state):
+        names = state.pop("names")
+        self.__dict__.update(state)
+        self.blocks = [shared_memory.SharedMemory(name=name) for name in names]
+        self._attach()
+
+    def close(self):
+        """Release the shared memory, freeing it in the process that created it"""
+        if not hasattr(self, "data"):
+            return
+        del self.slot_of, self.sample_of, self.last_used, self.counters, self.data
+        for block in self.blocks:
+            block.close()
+            if os.getpid() == self.owner_pid:
+                block.unlink()
+
+    def __del__(self):
+        self.close()
@@ -4,14 +4,18 @@ Generate Masks from Tiffs / Shapefiles
 This module has utilities for converting raw geotiffs into numpy arrays that
 can be used for subsequent training.
 """
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
 import argparse
+import json
+import multiprocessing
 import os
 import pathlib
 import warnings
 import numpy as np
 from rasterio.features import rasterize
-from shapely.geometry import box, Polygon
-from shapely.ops import cascaded_union
+from rasterio.windows import Window
+from shapely.geometry import box
 import geopandas as gpd
 import pandas as pd
 import rasterio
@@ -21,7 +25,7 @@ warnings.simplefilter(action="ignore", category=FutureWarning)
 
 
 def generate_masks(img_paths, shps_paths, border_paths=[], output_base="mask",
-                   out_dir=None):
+                   out_dir=None, block_size=None):
     """A wrapper of generate_mask, to make labels for each input
 
     Args:
@@ -30,6 +34,8 @@ def generate_masks(img_paths, shps_paths, border_paths=[], output_base="mask",
         border_paths(List): A list of Strings of the paths to the border polygon
         output_base(String): The basenames for all the output numpy files
         out_dir(String): The directory to which all the results are saved
+        block_size(int): If given, rasterize block_size x block_size windows
+          at a time straight into the output files, see generate_mask_tiled
     Returns:
         Writes a csv to metadata path
     """
@@ -48,51 +54,204 @@ def generate_masks(img_paths, shps_paths, border_paths=[], output_base="mask",
 
     for k, img_path in enumerate(img_paths):
         print(f"working on image {k + 1} / {len(img_paths)}")
-        img, shps = rasterio.open(img_path), []
-        for path in shps_paths[k]:
-            gdf = gpd.read_file(path)
-            gdf_crs = rasterio.crs.CRS.from_string(gdf.crs.to_string())
-            if gdf_crs != img.meta["crs"]:
-                gdf = gdf.to_crs(img.meta["crs"].data)
-            shps.append(gdf)
-
-        # build mask over tiff's extent, and save
-        shps = clip_shapefile(img.bounds, img.meta, shps)
-        mask = generate_mask(img.meta, shps)
-        out_path = pathlib.Path(out_dir, f"{output_base}_{k:02}")
-        np.save(str(out_path), mask)
-        # get borders
-        if border_paths:
-            border_mask = get_border_mask(img, border_paths[k])
-            border_path = pathlib.Path(out_dir, f"border_{k:02}.npy")
-            np.save(str(border_path), border_mask)
-        else:
-            border_path = None
-
-        pd.DataFrame({
-                "img_path": img_path,
-                "mask": str(out_path) + ".npy",
-                "border": str(border_path),
-                "width": img.meta["width"],
-                "height": img.meta["height"],
-                "mask_width": mask.shape[1],
-                "mask_height": mask.shape[0],
-            },
-            index=[k],
-        ).to_csv(metadata_path, header=False, mode="a")
+        border_path = border_paths[k] if border_paths else None
+        row = mask_image(k, img_path, shps_paths[k], border_path, output_base,
+                         out_dir, block_size)
+        pd.DataFrame(row, index=[k]).to_csv(metadata_path, header=False, mode="a")
+
+
+def generate_masks_parallel(img_paths, shps_paths, border_paths=[],
+                            output_base="mask", out_dir=None, block_size=None,
+                            n_workers=None):
+    """Make labels for each input over a pool of processes, resumably
+
+    Each image's mask and border are written atomically, followed by a
+    {output_base}_{k}.json record of its metadata. Images whose record
+    exists and whose masks load with the expected shape are skipped, so an
+    interrupted run can be restarted with the same arguments. The
+    mask_metadata.csv is assembled from the records at the end.
+
+    The shapefiles are read and reprojected in this process, once for each
+    CRS of the images, before the workers are forked, so that they inherit
+    them rather than each reading them again. Where fork is not available,
+    each worker reads the shapefiles it needs once.
+
+    Args:
+        image_paths(List): A list of Strings of the paths to the raw images
+        shps_paths(List): A list of Strings of the paths to the raw polygons
+        border_paths(List): A list of Strings of the paths to the border polygon
+        output_base(String): The basenames for all the output numpy files
+        out_dir(String): The directory to which all the results are saved
+        block_size(int): If given, rasterize block_size x block_size windows
+          at a time straight into the output files, see generate_mask_tiled
+        n_workers(int): The number of worker processes. Defaults to the number
+          of cpus.
+    Returns:
+        Writes a csv to metadata path
+    """
+    if not out_dir:
+        out_dir = pathlib.Path("processed", "masks")
+    pathlib.Path(out_dir).mkdir(parents=True, exist_ok=True)
+
+    records = [pathlib.Path(out_dir, f"{output_base}_{k:02}.json") for k in range(len(img_paths))]
+    todo = [
+        k for k, img_path in enumerate(img_paths)
+        if not mask_done(records[k], img_path, len(shps_paths[k]))
+    ]
+    print(f"{len(img_paths) - len(todo)} / {len(img_paths)} masks already done")
+
+    mp_context = None
+    if todo and "fork" in multiprocessing.get_all_start_methods():
+        mp_context = multiprocessing.get_context("fork")
+        for k in todo:
+            crs = rasterio.open(img_paths[k]).meta["crs"]
+            for path in list(shps_paths[k]) + ([border_paths[k]] if border_paths else []):
+                read_shapefile(path, crs)
+
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=mp_context) as executor:
+        futures = [
+            executor.submit(
+                mask_image, k, img_paths[k], shps_paths[k],
+                border_paths[k] if border_paths else None, output_base,
+                out_dir, block_size
+            )
+            for k in todo
+        ]
+        for i, future in enumerate(as_completed(futures)):
+            future.result()
+            print(f"finished image {i + 1} / {len(todo)}")
+
+    rows = [json.load(open(path, "r")) for path in records]
+    cols = ["img", "mask", "border",
+            "img_width", "img_height", "mask_width", "mask_height"]
+    metadata_path = pathlib.Path(out_dir, "mask_metadata.csv")
+    tmp_path = metadata_path.with_suffix(".tmp")
+    pd.DataFrame(rows).to_csv(tmp_path, header=cols, index_label="id")
+    os.replace(tmp_path, metadata_path)
+
+
+def mask_image(k, img_path, shps_paths, border_path=None, output_base="mask",
+               out_dir=None, block_size=None):
+    """Make the mask (and border) for a single image
+
+    The .npy files are written under temporary names and then renamed, and
+    the image's metadata is then recorded in {output_base}_{k}.json, so that
+    an interrupted run never leaves behind a partial mask that looks done.
+
+    Args:
+        k(int): The index of the image
+        img_path(String): The path to the raw image
+        shps_paths(List): A list of Strings of the paths to the raw polygons
+        border_path(String): The path to the border polygon
+        output_base(String): The basenames for all the output numpy files
+        out_dir(String): The directory to which all the results are saved
+        block_size(int): If given, rasterize block_size x block_size windows
+          at a time straight into the output files, see generate_mask_tiled
+    Returns:
+        dict with the image's row of the mask metadata
+    """
+    img = rasterio.open(img_path)
+    shps = [read_shapefile(path, img.meta["crs"]) for path in shps_paths]
+
+    # build mask over tiff's extent, and save
+    shps = clip_shapefile(img.bounds, img.meta, shps)
+    out_path = pathlib.Path(out_dir, f"{output_base}_{k:02}")
+    tmp_path = pathlib.Path(out_dir, f"{output_base}_{k:02}.tmp.npy")
+    mask = write_mask(img.meta, shps, str(tmp_path), block_size)
+    mask_shape = mask.shape
+    del mask
+    os.replace(tmp_path, str(out_path) + ".npy")
+
+    # get borders
+    if border_path:
+        border = read_shapefile(border_path, img.meta["crs"])
+        border = clip_shapefile(img.bounds, img.meta, [border])
+        out_border = pathlib.Path(out_dir, f"border_{k:02}.npy")
+        tmp_path = pathlib.Path(out_dir, f"border_{k:02}.tmp.npy")
+        write_mask(img.meta, border, str(tmp_path), block_size)
+        os.replace(tmp_path, out_border)
+    else:
+        out_border = None
+
+    row = {
+        "img_path": str(img_path),
+        "mask": str(out_path) + ".npy",
+        "border": str(out_border),
+        "width": img.meta["width"],
+        "height": img.meta["height"],
+        "mask_width": mask_shape[1],
+        "mask_height": mask_shape[0],
+    }
+    record_path = pathlib.Path(out_dir, f"{output_base}_{k:02}.json")
+    with open(record_path.with_suffix(".tmp"), "w") as f:
+        json.dump(row, f)
+    os.replace(record_path.with_suffix(".tmp"), record_path)
+    return row
+
+
+def mask_done(record_path, img_path, n_channels):
+    """Check whether an image's mask was completely written
+
+    Args:
+        record_path(String): The path to the image's json record
+        img_path(String): The path to the raw image
+        n_channels(int): The expected number of mask channels
+    Returns:
+        True if the record exists and its masks load with the expected shape
+    """
+    try:
+        row = json.load(open(record_path, "r"))
+        shape = (row["height"], row["width"])
+        if row["img_path"] != str(img_path):
+            return False
+        if np.load(row["mask"], mmap_mode="r").shape != shape + (n_channels,):
+            return False
+        if row["border"] != "None":
+            return np.load(row["border"], mmap_mode="r").shape == shape + (1,)
+        return True
+    except (OSError, ValueError, KeyError):
+        return False
+
 
 def get_border_mask(img, border_path):
     """Get mask of a border"""
     #TODO: Use one function for any mask
-    gdf = gpd.read_file(border_path)
-    gdf_crs = rasterio.crs.CRS.from_string(gdf.crs.to_string())
-    if gdf_crs != img.meta["crs"]:
-        gdf = gdf.to_crs(img.meta["crs"].data)
+    gdf = read_shapefile(border_path, img.meta["crs"])
     gdf = clip_shapefile(img.bounds, img.meta, [gdf])[0]
     mask = generate_mask(img.meta, [gdf])
 
     return mask
 
+
+def read_shapefile(path, crs):
+    """Read a shapefile, reprojected to a given CRS
+
+    Each shapefile is read, reprojected, and spatially indexed once per
+    process for each target CRS, and then shared across images. Processes
+    forked afterwards inherit the cache, see generate_masks_parallel.
+
+    :param path: The path to the shapefile.
+    :type path: string
+    :param crs: The coordinate reference system to project to.
+    :type crs: rasterio.crs
+    :return gdf: The reprojected shapefile.
+    :type gdf: gpd.GeoDataFrame
+    """
+    return _read_shapefile(str(path), crs.to_string())
+
+
+@lru_cache(maxsize=None)
+def _read_shapefile(path, crs_string):
+    crs = rasterio.crs.CRS.from_string(crs_string)
+    gdf = gpd.read_file(path)
+    gdf_crs = rasterio.crs.CRS.from_string(gdf.crs.to_string())
+    if gdf_crs != crs:
+        gdf = gdf.to_crs(crs.data)
+
+    # build the spatial index once, so clipping each image can reuse it
+    _ = gdf.sindex
+    return gdf
+
 def check_crs(crs_a, crs_b):
     """Verify that two CRS objects Match
 
@@ -128,27 +287,92 @@ def generate_mask(img_meta, shps):
     return result
 
 
+def write_mask(img_meta, shps, out_path, block_size=None):
+    """Generate K-Channel Label Masks and save them to a .npy file
+
+    :param img_meta: The metadata field associated with a geotiff.
+    :type img_meta: rasterio.metadata
+    :param shps: A list of K geopandas shapefiles, used to build the mask.
+    :type: [gpd.GeoDataFrame]
+    :param out_path: The path of the .npy file to write.
+    :type out_path: string
+    :param block_size: If given, rasterize one block at a time with
+      generate_mask_tiled, instead of building the whole mask in memory.
+    :type block_size: int
+    :return mask: The mask that was written.
+    """
+    if block_size:
+        return generate_mask_tiled(img_meta, shps, out_path, block_size)
+
+    mask = generate_mask(img_meta, shps)
+    np.save(out_path, mask)
+    return mask
+
+
+def generate_mask_tiled(img_meta, shps, out_path, block_size=2048):
+    """Generate K-Channel Label Masks block by block, into a .npy file
+
+    The mask is written into a memory mapped .npy file, one block_size x
+    block_size window at a time, so memory use doesn't depend on the size of
+    the raster. Only windows that intersect some polygon (found with the
+    shapefile's spatial index) are rasterized; the rest stay zero. The
+    result is the same as saving generate_mask's output.
+
+    :param img_meta: The metadata field associated with a geotiff. Expected to
+      contain transform (coordinate system), height, and width fields.
+    :type img_meta: rasterio.metadata
+    :param shps: A list of K geopandas shapefiles, used to build the mask.
+      Assumed to be in the same coordinate system as img_data.
+    :type: [gpd.GeoDataFrame]
+    :param out_path: The path of the .npy file to write.
+    :type out_path: string
+    :param block_size: The height and width of the windows to rasterize.
+    :type block_size: int
+    :return mask: The memory mapped mask.
+    """
+    shape = (img_meta["height"], img_meta["width"], len(shps))
+    result = np.lib.format.open_memmap(out_path, mode="w+", dtype="uint8", shape=shape)
+
+    for k, shp in enumerate(shps):
+        check_crs(img_meta["crs"], shp.crs)
+        for row in range(0, shape[0], block_size):
+            for col in range(0, shape[1], block_size):
+                window = Window(col, row, min(block_size, shape[1] - col),
+                                min(block_size, shape[0] - row))
+                bounds = rasterio.windows.bounds(window, img_meta["transform"])
+                ix = shp.sindex.query(box(*bounds), predicate="intersects")
+                if len(ix) == 0:
+                    continue
+
+                window_meta = {
+                    "height": window.height,
+                    "width": window.width,
+                    "transform": rasterio.windows.transform(window, img_meta["transform"]),
+                }
+                result[row:(row + window.height), col:(col + window.width), k] = \
+                    channel_mask(window_meta, shp.iloc[np.sort(ix)])
+
+    result.flush()
+    return result
+
+
 def channel_mask(img_meta, shp):
     """Generate 1-channel label mask over raster Image
 
+    The geometries are burned in directly, using the raster's affine
+    transform, so polygon holes and multipolygons are kept as they are.
+
     Args:
       img_meta (rasterio.metadata): The metadata associated with the location
         on which to build the mask.
       shp (gpd.GeoDataFrame): A geopandas shapefile, used to build the mask.
     """
-    poly_shp = []
-    for _, row in shp.iterrows():
-        if row["geometry"].geom_type == "Polygon":
-            poly_shp += [poly_from_coord(row["geometry"], img_meta["transform"])]
-
-        else:  # case if multipolygon
-            for geom in row["geometry"]:
-                poly_shp += [poly_from_coord(geom, img_meta["transform"])]
-
     im_size = (img_meta["height"], img_meta["width"])
+    geoms = [g for g in shp["geometry"] if g is not None and not g.is_empty]
 
     try:
-        result = rasterize(shapes=poly_shp, out_shape=im_size)
+        result = rasterize(shapes=geoms, out_shape=im_size,
+                           transform=img_meta["transform"])
     except ValueError as e:
         if str(e) == 'No valid geometry objects found for rasterize':
             result = np.zeros(im_size)
@@ -157,17 +381,6 @@ def channel_mask(img_meta, shp):
     return result
 
 
-def poly_from_coord(polygon, transform):
-    """Get a transformed polygon
-    https://lpsmlgeo.github.io/2019-09-22-binary_mask/
-    """
-    poly_pts = []
-    poly = cascaded_union(polygon)
-    for i in np.array(poly.exterior.coords):
-        poly_pts.append(~transform * tuple(i)[:2])  # in case polygonz format
-    return Polygon(poly_pts)
-
-
 def clip_shapefile(img_bounds, img_meta, shps):
     """Clip Shapefile Extents to Image Bounding Box
 
@@ -184,11 +397,9 @@ def clip_shapefile(img_bounds, img_meta, shps):
       overlap the img bounding box removed.
     """
     bbox = box(*img_bounds)
-    bbox_poly = gpd.GeoDataFrame(
-        {"geometry": bbox}, index=[0], crs=img_meta["crs"].data
-    )
     result = []
     for shp in shps:
         check_crs(img_meta["crs"], shp.crs)
-        result.append(shp.loc[shp.intersects(bbox_poly["geometry"][0])])
+        ix = shp.sindex.query(bbox, predicate="intersects")
+        result.append(shp.iloc[np.sort(ix)])
     return result
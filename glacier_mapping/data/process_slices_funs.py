@@ -2,6 +2,8 @@
 """
 Functions to support slice processing
 """
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import lru_cache, partial
 from pathlib import Path
 from shutil import copyfile
 import json
@@ -10,7 +12,22 @@ import random
 import sys
 import numpy as np
 import geopandas as gpd
+import pandas as pd
 import random
+from tqdm import tqdm
+from .storage import (
+    ENCODING_NAME,
+    ShardWriter,
+    copy_encoding,
+    decode_slice,
+    load_slice,
+    open_shards,
+    read_encoding,
+    reshuffle_shards,
+    save_slice,
+    select_channels,
+    write_manifest,
+)
 
 
 def filter_directory(slice_meta, filter_perc=[0.2], filter_channel=[1]):
@@ -25,15 +42,36 @@ def filter_directory(slice_meta, filter_perc=[0.2], filter_channel=[1]):
         img and mask
 
     """
-    for i, channel in enumerate(filter_channel):
-        slice_meta = slice_meta[slice_meta[f"mask_mean_{channel}"] > filter_perc[i]]
-    slice_meta = slice_meta[slice_meta["img_mean"] > 0]
+    keep = filter_mask(slice_meta, filter_perc, filter_channel)
+    if "filtered" in slice_meta.columns:
+        keep &= ~slice_meta["filtered"].astype(bool)
+    slice_meta = slice_meta[keep]
     return [
         {"img": d["img_slice"], "mask": d["mask_slice"]}
         for _, d in slice_meta.iterrows()
     ]
 
 
+def filter_mask(slice_stats, filter_perc=[0.2], filter_channel=[1]):
+    """ Which slices pass the Filter Criteria
+
+    Args:
+        slice_stats(pd.DataFrame): The slice metadata, with mask_mean_{channel}
+          and img_mean columns.
+        filter_perc([float]): The minimum percentages 1's in the filter_channels
+                              needed to pass the filter.
+        filter_channel([int]): The channels to do the filtering on.
+
+    Return:
+        Boolean pd.Series, True for the slices passing the filter
+
+    """
+    keep = slice_stats["img_mean"] > 0
+    for i, channel in enumerate(filter_channel):
+        keep &= slice_stats[f"mask_mean_{channel}"] > filter_perc[i]
+    return keep
+
+
 def random_split(ids, split_ratio, seed=0,**kwargs):
     """ Randomly split a list of paths into train / dev / test
 
@@ -56,85 +94,184 @@ def random_split(ids, split_ratio, seed=0,**kwargs):
     }
 
 
-def geographic_split(ids, geojsons, slice_meta, dev_ratio=0.10, crs=3857, **kwargs):
+def geographic_split(ids, geojsons, slice_meta, dev_ratio=0.10, crs=3857,
+                     seed=0, **kwargs):
     """ Split according to specified geojson coordinates
+
+    Args:
+        ids(list of dict): A list of dictionaries, each with keys "img" and
+          "mask" giving paths to data that need to be split.
+        geojsons(dict): Paths to the geojsons delimiting the train and test
+          regions. Slices lying within the train region are split between
+          train and dev.
+        slice_meta(gpd.GeoDataFrame): The slice metadata, with the geometry
+          of each img_slice.
+        dev_ratio(float): The fraction of train region slices to put in dev.
+        crs: The coordinate reference system in which to compare geometries.
+        seed(int): The seed for sampling dev slices.
+
+    Return:
+        Train/Test/Dev splits
     """
     splits = {"train": [], "dev": [], "test": []}
-
+    position = pd.Series(np.arange(len(ids)), index=[d["img"] for d in ids])
+    slice_meta = slice_meta[slice_meta["img_slice"].isin(position.index)]
+    slices = gpd.GeoDataFrame(
+        {"position": position[slice_meta["img_slice"]].values},
+        geometry=slice_meta["geometry"].to_crs(crs).buffer(0).values,
+        crs=crs
+    )
+
+    rng = np.random.default_rng(seed)
     for k, path in geojsons.items():
-        split_geo = gpd.read_file(path)
-        split_geo = split_geo.to_crs(crs).buffer(0)
-
-        i = 1
-        for slice_id in ids:
-            print(f"determing split for slice {i}/{len(ids)}")
-            i += 1
-
-            # get the row of the pandas with the current slice id
-            slice_geo = slice_meta[slice_meta.img_slice == slice_id["img"]]["geometry"]
-            slice_geo = slice_geo.to_crs(crs).reset_index().buffer(0)
-
-            if split_geo.contains(slice_geo)[0]:
-                if k == "train":
-                    if random.random() < dev_ratio:
-                        splits["dev"].append(slice_id)
-                    else:
-                        splits["train"].append(slice_id)
-                else:
-                        splits["test"].append(slice_id)
+        split_geo = gpd.read_file(path).to_crs(crs)
+        split_geo = gpd.GeoDataFrame(geometry=split_geo.buffer(0), crs=crs)
+        try:
+            joined = gpd.sjoin(slices, split_geo, predicate="within")
+        except TypeError:  # geopandas < 0.10
+            joined = gpd.sjoin(slices, split_geo, op="within")
+
+        positions = np.unique(joined["position"])
+        if k == "train":
+            is_dev = rng.random(len(positions)) < dev_ratio
+            splits["dev"] += [ids[i] for i in positions[is_dev]]
+            splits["train"] += [ids[i] for i in positions[~is_dev]]
+        else:
+            splits["test"] += [ids[i] for i in positions]
 
     return splits
 
 
-def reshuffle(split_ids, output_dir="output/"):
+def reshuffle(split_ids, output_dir="output/", shard_size=1024, mode="copy", n_workers=8):
     """ Reshuffle Data for Training,
     given a dictionary specifying train / dev / test split,
-    copy into train / dev / test folders.
+    place the slices into train / dev / test folders.
 
     Args:
         split_ids(int): IDs of files to split
         output_dir(str): Directory to place the split dataset
+        shard_size(int): The number of slices per shard, when the slices to
+          split are stored in shards
+        mode(str): How to place the slices in the split folders. One of
+          "copy", "hardlink" (falling back to a copy across filesystems),
+          "symlink", or "manifest", which only writes a manifest.csv of the
+          source paths to each folder. In manifest mode, the target locations
+          are the source slices themselves, so they must not be postprocessed
+          in place: postprocess them through a TensorCache instead (see
+          --cache_dir in scripts/train.py). Slices stored in shards are always
+          rewritten into the split's own shards, unless mode is "manifest".
+        n_workers(int): The number of threads placing files
     Return:
         Target locations
     """
+    if mode not in ["copy", "hardlink", "symlink", "manifest"]:
+        raise ValueError(f"Unknown reshuffle mode {mode}.")
+
     for split_type in split_ids:
         path = Path(output_dir, split_type)
         os.makedirs(path, exist_ok=True)
 
+    if mode == "manifest":
+        for split_type, ids in split_ids.items():
+            write_manifest(Path(output_dir, split_type), ids)
+        return {
+            k: [{"img": Path(d["img"]).resolve(), "mask": Path(d["mask"]).resolve()} for d in v]
+            for k, v in split_ids.items()
+        }
+
+    ids = [d for v in split_ids.values() for d in v]
+    if ids and not Path(ids[0]["img"]).exists():
+        return reshuffle_shards(split_ids, output_dir, shard_size)
+
     target_locs = {k: [] for k in split_ids}
+    tasks = []
     for split_type in split_ids:
         for i in range(len(split_ids[split_type])):
             cur_locs = {}
             for im_type in ["img", "mask"]:
-                print(f"shuffling image {i} - {im_type}")
                 source = split_ids[split_type][i][im_type]
                 target = Path(
                     output_dir, split_type, os.path.basename(source)
                 ).resolve()
-                copyfile(source, target)
+                tasks.append((source, target))
                 cur_locs[im_type] = target
 
             target_locs[split_type].append(cur_locs)
+
+    with ThreadPoolExecutor(n_workers) as executor:
+        futures = [executor.submit(place_file, s, t, mode) for s, t in tasks]
+        for f in tqdm(as_completed(futures), total=len(futures), desc="reshuffle"):
+            f.result()
+
+    for split_type, ids in split_ids.items():
+        if ids:
+            copy_encoding(Path(ids[0]["img"]).parent, Path(output_dir, split_type))
     return target_locs
 
 
-def generate_stats(image_paths, sample_size, outpath="stats.json"):
+def place_file(source, target, mode="copy"):
+    """ Place a copy or a link of source at target
+
+    Args:
+        source(str): The path of the existing file
+        target(str): The path to place it at. Any file already there is removed.
+        mode(str): One of "copy", "hardlink", or "symlink"
+    """
+    if os.path.lexists(target):
+        os.remove(target)
+
+    if mode == "symlink":
+        os.symlink(Path(source).resolve(), target)
+        return
+    if mode == "hardlink":
+        try:
+            os.link(source, target)
+            return
+        except OSError:
+            pass
+    copyfile(source, target)
+
+
+def generate_stats(image_paths, sample_size, outpath="stats.json", streaming=False,
+                   n_workers=None, chunk_size=64):
     """ Function to generate statistics of the input image channels
 
     Args:
         image_paths: List of Paths to images in directory
-        sample_size(int): integer giving the size of the sample from which to compute the statistics
+        sample_size(int): integer giving the size of the sample from which to
+          compute the statistics. None uses all the images.
         outpath(str): The path to the output json file containing computed statistics
+        streaming(bool): Whether to accumulate the statistics one slice at a
+          time, in constant memory, across worker processes, rather than
+          stacking the whole sample into one array
+        n_workers(int): The number of worker processes, when streaming.
+          Defaults to the number of CPUs.
+        chunk_size(int): The number of slices per worker task, when streaming
 
     Return:
          Dictionary with keys for means and stds across the channels in input images
     """
+    if sample_size is None:
+        sample_size = len(image_paths)
     sample_size = min(sample_size, len(image_paths))
     image_paths = np.random.choice(image_paths, sample_size, replace=False)
-    images = [np.load(image_path) for image_path in image_paths]
-    batch = np.stack(images)
-    means = np.nanmean(batch, axis=(0, 1, 2))
-    stds = np.nanstd(batch, axis=(0, 1, 2))
+
+    if streaming:
+        chunks = [
+            image_paths[i:i + chunk_size]
+            for i in range(0, len(image_paths), chunk_size)
+        ]
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            partials = list(tqdm(executor.map(channel_moments, chunks), total=len(chunks)))
+        counts, means, m2 = merge_moments(partials)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = np.where(counts > 0, means, np.nan)
+            stds = np.sqrt(m2 / counts)
+    else:
+        images = [load_slice(image_path) for image_path in image_paths]
+        batch = np.stack(images)
+        means = np.nanmean(batch, axis=(0, 1, 2))
+        stds = np.nanstd(batch, axis=(0, 1, 2))
 
     with open(outpath, "w+") as f:
         stats = {"means": means.tolist(), "stds": stds.tolist()}
@@ -143,26 +280,102 @@ def generate_stats(image_paths, sample_size, outpath="stats.json"):
     return stats
 
 
+def channel_moments(image_paths):
+    """ NaN-aware per-channel count, mean, and sum of squared deviations
+
+    Each slice's moments are computed directly, then merged into the running
+    totals with Chan et al.'s pairwise update, so only one slice is in memory
+    at a time.
+
+    Args:
+        image_paths: List of Paths to images
+
+    Return:
+        (counts, means, m2) tuple of arrays with one entry per channel
+    """
+    result = None
+    for image_path in image_paths:
+        img = load_slice(image_path)
+        x = img.reshape(-1, img.shape[-1]).astype(np.float64)
+        counts = np.count_nonzero(~np.isnan(x), axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = np.nan_to_num(np.nansum(x, axis=0) / counts)
+        x -= means
+        m2 = np.nansum(np.square(x, out=x), axis=0)
+        moments = (counts, means, m2)
+        result = moments if result is None else merge_moments([result, moments])
+    return result
+
+
+def merge_moments(moments):
+    """ Merge per-channel (counts, means, m2) moments of disjoint samples
+
+    Args:
+        moments: List of (counts, means, m2) tuples
+
+    Return:
+        (counts, means, m2) of the union of the samples
+    """
+    counts, means, m2 = moments[0]
+    for counts_b, means_b, m2_b in moments[1:]:
+        total = counts + counts_b
+        delta = means_b - means
+        with np.errstate(invalid="ignore", divide="ignore"):
+            weight = np.where(total > 0, counts_b / total, 0)
+        means = means + delta * weight
+        m2 = m2 + m2_b + delta ** 2 * counts * weight
+        counts = total
+    return counts, means, m2
+
+
 def normalize_(img, means, stds):
     """
     Args:
-        img: Input image to normalize
-        means: Computed mean of the input channels
+        img: Input image to normalize, with channels along the last axis
+        means: Computed mean of the input channels. The statistics apply to
+          the channels of img by position, and any extra ones are ignored.
         stds: Computed standard deviation of the input channels
 
     Return:
         img: Normalized img
     """
-    for i in range(img.shape[2]):
-        img[:, :, i] -= means[i]
-        if stds[i] > 0:
-            img[:, :, i] /= stds[i]
-        else:
-            img[:, :, i] = 0
-
+    means, stds = _channel_stats(means, stds, img.shape[-1])
+    img -= means.astype(img.dtype)
+    np.divide(img, stds.astype(img.dtype), out=img, where=stds > 0)
+    if np.any(stds <= 0):
+        img[..., stds <= 0] = 0
     return img
 
 
+def _channel_stats(means, stds, n_channels):
+    # the first n_channels statistics, those of the channels present
+    means, stds = np.asarray(means), np.asarray(stds)
+    if len(means) < n_channels or len(stds) < n_channels:
+        n_stats = min(len(means), len(stds))
+        raise ValueError(f"Statistics of {n_stats} channels cannot normalize {n_channels} channels.")
+    return means[:n_channels], stds[:n_channels]
+
+
+def load_stats(stats_path):
+    """Load (cached) dataset statistics
+
+    The cache is invalidated whenever the statistics file changes.
+
+    Args:
+        stats_path: path to dataset statistics
+
+    Return:
+        (means, stds) tuple of float64 arrays
+    """
+    return _load_stats(str(stats_path), os.stat(stats_path).st_mtime_ns)
+
+
+@lru_cache(maxsize=32)
+def _load_stats(stats_path, mtime):
+    stats = json.load(open(stats_path, "r"))
+    return np.asarray(stats["means"], dtype=np.float64), np.asarray(stats["stds"], dtype=np.float64)
+
+
 def normalize(img, mask, stats_path):
     """wrapper for postprocess
 
@@ -174,8 +387,8 @@ def normalize(img, mask, stats_path):
     Return:
         Normalized image and corresponding mask
     """
-    stats = json.load(open(stats_path, "r"))
-    img = normalize_(img, stats["means"], stats["stds"])
+    means, stds = load_stats(stats_path)
+    img = normalize_(img, means, stds)
     return img, mask
 
 
@@ -223,24 +436,231 @@ def add_bg_channel(img, mask):
 
     Return:
         Image and the mask with added background"""
-    bg_mask = ~ mask.any(axis=2)
-    mask = np.dstack((mask, bg_mask))
-    return img, mask
+    shape = mask.shape[:-1] + (mask.shape[-1] + 1,)
+    result = np.empty(shape, dtype=np.result_type(mask, bool))
+    result[..., :-1] = mask
+    np.logical_not(mask.any(axis=-1), out=result[..., -1])
+    return img, result
+
+
+def class_index(img, mask):
+    """Replace a one-hot mask with a map of class indices
+
+    The index map is K times smaller than the one-hot mask, and is what
+    multi-class losses consume. Apply it after add_bg_channel, so that every
+    pixel has a class.
+
+    Args:
+        img: Image
+        mask: One-hot mask, with the classes along the last axis
+
+    Return:
+        Image and the uint8 class index of each pixel, the mask without its
+        last axis
+    """
+    if mask.shape[-1] > np.iinfo(np.uint8).max + 1:
+        raise ValueError("Class index maps hold at most 256 classes.")
+    return img, np.argmax(mask, axis=-1).astype(np.uint8)
+
+
+class ProcessPipeline:
+    """A compiled list of processing functions
+
+    The process_funs from the postprocessing configuration are resolved once.
+    Runs of impute, normalize, extract_channel, add_bg_channel, and
+    class_index are fused: the image channels to keep are extracted first,
+    into the only copy of the image, and the statistics are indexed to match,
+    so that normalization and imputation run in place over the channels that
+    are kept. Any other function is called as in postprocess_.
+
+    Images and masks have their channels along the last axis, so the
+    pipeline accepts single tiles (H, W, C) as well as batches (N, H, W, C).
+
+    Usage::
+
+        pipeline = ProcessPipeline(pconf.process_funs)
+        img, mask = pipeline(img, mask)
+    """
+
+    fusable = ["impute", "normalize", "extract_channel", "add_bg_channel", "class_index"]
+
+    def __init__(self, process_funs):
+        """Compile the processing functions.
+
+        Args:
+            process_funs: Specified process functions, a mapping from function
+              names to their keyword arguments
+        """
+        self.stages = []
+        for fun_name, fun_args in process_funs.items():
+            if fun_name in self.fusable:
+                if not self.stages or not isinstance(self.stages[-1], _FusedStage):
+                    self.stages.append(_FusedStage())
+                self.stages[-1].add(fun_name, **fun_args)
+            else:
+                self.stages.append(partial(getattr(sys.modules[__name__], fun_name), **fun_args))
+
+    @property
+    def input_channels(self):
+        """The image channels the pipeline reads, or None for all of them
+
+        Reading only these channels from storage (e.g., load_slice(path,
+        channels=pipeline.input_channels)), and passing selected=True, gives
+        the same result as processing the full image.
+        """
+        if self.stages and isinstance(self.stages[0], _FusedStage):
+            return self.stages[0].img_channels
+        return None
+
+    def __call__(self, img, mask=None, selected=False):
+        """Process an image and mask
+
+        Args:
+            img: Image, or batch of images, to process
+            mask: The corresponding mask(s). If None, only the image is
+              processed, by the fused functions.
+            selected(bool): Whether img only has the input_channels, already
+              selected when it was read
+
+        Return:
+            Processed image and mask
+        """
+        for k, stage in enumerate(self.stages):
+            if k == 0 and selected and isinstance(stage, _FusedStage):
+                img, mask = stage(img, mask, selected=True)
+            else:
+                img, mask = stage(img, mask)
+        return img, mask
+
+
+class _FusedStage:
+    """impute, normalize, extract_channel, add_bg_channel, and class_index
+    applied together
+
+    Channel selection commutes with the per-channel imputation and
+    normalization, so it is always applied first. Normalizations are applied
+    in place, in order, multiplying by the reciprocal of the standard
+    deviation (0 for channels without variance). As in normalize_, the
+    statistics apply to the channels present by position, so a normalize
+    after extract_channel uses the first statistics. Imputation is deferred
+    to the end: the value each imputed pixel would have after the
+    normalizations that follow is computed once per channel, and written
+    wherever the result is NaN.
+    """
+
+    def __init__(self):
+        self.img_channels = None
+        self.normalizations = []
+        self.fill = np.nan
+        self.mask_funs = []
+
+    def _select(self, x, channels):
+        # per-channel constants recorded before a channel selection
+        return x if np.ndim(x) == 0 else x[channels]
+
+    def add(self, fun_name, **fun_args):
+        """Append one of the fusable functions"""
+        if fun_name == "impute":
+            self.fill = np.where(np.isnan(self.fill), fun_args.get("value", 0), self.fill)
+        elif fun_name == "normalize":
+            means, stds = load_stats(fun_args["stats_path"])
+            if self.img_channels is not None:
+                means, stds = _channel_stats(means, stds, len(self.img_channels))
+            # a channel without variance is set to 0, even where it is NaN
+            with np.errstate(invalid="ignore", divide="ignore"):
+                self.fill = np.where(stds > 0, (self.fill - means) / stds, 0)
+            with np.errstate(divide="ignore"):
+                self.normalizations.append((means, np.where(stds > 0, 1 / stds, 0)))
+        elif fun_name == "extract_channel":
+            img_channels = fun_args.get("img_channels")
+            if img_channels is not None:
+                img_channels = np.asarray(img_channels)
+                self.normalizations = [
+                    (m[img_channels], s[img_channels]) for m, s in self.normalizations
+                ]
+                self.fill = self._select(self.fill, img_channels)
+                if self.img_channels is not None:
+                    img_channels = self.img_channels[img_channels]
+                self.img_channels = img_channels
+            self.mask_funs.append(partial(_extract_mask_channel, mask_channels=fun_args.get("mask_channels")))
+        elif fun_name == "add_bg_channel":
+            self.mask_funs.append(_add_mask_bg_channel)
+        elif fun_name == "class_index":
+            self.mask_funs.append(_class_index_mask)
+
+    def __call__(self, img, mask=None, selected=False):
+        dtype = np.result_type(img.dtype, np.float32)
+        if self.img_channels is None or selected:
+            out = np.array(img, dtype=dtype)
+        else:
+            out = np.take(img, self.img_channels, axis=-1).astype(dtype, copy=False)
+
+        n_channels = out.shape[-1]
+        for means, scales in self.normalizations:
+            means, scales = _channel_stats(means, scales, n_channels)
+            np.subtract(out, means.astype(dtype), out=out)
+            np.multiply(out, scales.astype(dtype), out=out)
+        if not np.all(np.isnan(self.fill)):
+            fill = self.fill if np.ndim(self.fill) == 0 else self.fill[:n_channels]
+            np.copyto(out, np.broadcast_to(fill, out.shape[-1:]).astype(dtype), where=np.isnan(out))
+
+        if mask is not None:
+            for f in self.mask_funs:
+                mask = f(mask)
+        return out, mask
+
+
+def _extract_mask_channel(mask, mask_channels=None):
+    if mask_channels is None:
+        return mask
+    return mask[..., mask_channels]
+
+
+def _add_mask_bg_channel(mask):
+    return add_bg_channel(None, mask)[1]
+
+
+def _class_index_mask(mask):
+    return class_index(None, mask)[1]
+
+
+def compile_process_funs(process_funs):
+    """Get a (cached) ProcessPipeline for the specified process functions
+
+    The cache is invalidated whenever a statistics file they use changes.
+
+    Args:
+        process_funs: Specified process functions, or an already compiled
+          ProcessPipeline, which is returned as is
+
+    Return:
+        A ProcessPipeline
+    """
+    if isinstance(process_funs, ProcessPipeline):
+        return process_funs
+    signature = tuple(
+        os.stat(fun_args["stats_path"]).st_mtime_ns
+        for fun_args in process_funs.values() if "stats_path" in fun_args
+    )
+    return _compile_process_funs(json.dumps(process_funs), signature)
+
+
+@lru_cache(maxsize=32)
+def _compile_process_funs(process_funs, signature):
+    return ProcessPipeline(json.loads(process_funs))
+
 
 def postprocess_tile(img, process_funs):
     """Apply a list of processing functions
 
     Args:
         img: Image to postprocess
-        process_funs: Specified process functions
+        process_funs: Specified process functions, or a ProcessPipeline
 
     Return:
-        Image, mask and specified process functions
+        Processed image, and None in place of the mask
     """
-    # create fake mask input
-    process_funs.extract_channel.mask_channels = 0
-    mask = np.zeros((img.shape[0], img.shape[1], 1))
-    return postprocess_(img, mask, process_funs)
+    return compile_process_funs(process_funs)(img)
 
 
 def postprocess_(img, mask, process_funs):
@@ -249,16 +669,12 @@ def postprocess_(img, mask, process_funs):
     Args:
         img: Image to postprocess
         mask: Mask to postprocess
-        process_funs: Specified post process functions
+        process_funs: Specified post process functions, or a ProcessPipeline
 
     Return:
         Post processed images and masks
     """
-    for fun_name, fun_args in process_funs.items():
-        f = getattr(sys.modules[__name__], fun_name)
-        img, mask = f(img, mask, **fun_args)
-
-    return img, mask
+    return compile_process_funs(process_funs)(img, mask)
 
 
 def postprocess(img_path, mask_path, process_funs):
@@ -273,5 +689,43 @@ def postprocess(img_path, mask_path, process_funs):
         Postprocess image, mask and postprocess function
 
     """
-    img, mask = np.load(img_path), np.load(mask_path)
-    return postprocess_(img, mask, process_funs)
+    pipeline = compile_process_funs(process_funs)
+    img = load_slice(img_path, channels=pipeline.input_channels)
+    return pipeline(img, load_slice(mask_path), selected=True)
+
+
+def postprocess_shards(folder_path, process_funs, shard_size=1024):
+    """process all the sharded slices in a directory
+
+    The processed slices are written to new shards, which then replace the
+    original ones. Encoded slices are decoded, and the processed slices are
+    stored as they are.
+
+    Args:
+        folder_path(str): Path to a directory of shards
+        process_funs: Specified process functions
+        shard_size(int): The number of slices per processed shard
+
+    """
+    folder_path = Path(folder_path)
+    reader = open_shards(folder_path)
+    old_files = list(folder_path.glob("*.bin")) + list(folder_path.glob("*.index.json"))
+    tmp_dir = folder_path / "tmp"
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    pipeline = compile_process_funs(process_funs)
+    encoding = read_encoding(folder_path)
+    with ShardWriter(tmp_dir, "slices", shard_size) as writer:
+        for k in range(len(reader)):
+            img, mask = reader[k]
+            img = decode_slice(select_channels(img, pipeline.input_channels, encoding), encoding)
+            img, mask = pipeline(img, np.array(decode_slice(mask, encoding, "mask")), selected=True)
+            writer.write(reader.img_names[k], img, reader.mask_names[k], mask)
+
+    if encoding is not None:
+        old_files.append(folder_path / ENCODING_NAME)
+    for path in old_files:
+        os.remove(path)
+    for path in tmp_dir.iterdir():
+        os.replace(path, folder_path / path.name)
+    os.rmdir(tmp_dir)
@@ -2,17 +2,22 @@
 """
 Convert Large Tiff and Mask files to Slices (512 x 512 subtiles)
 """
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import argparse
 import os
+import time
 import numpy as np
 from geopandas.geodataframe import GeoDataFrame
 from skimage.util.shape import view_as_windows
 import pandas as pd
 import rasterio
+from rasterio.windows import Window
 import shapely.geometry
 from tqdm import tqdm
 import matplotlib.pyplot as plt
+from .process_slices_funs import filter_mask
+from .storage import ShardWriter, encode_slice, load_slice, make_encoding, write_encoding
 
 
 def squash(x):
@@ -36,6 +41,17 @@ def slice_tile(img, size=(512, 512), overlap=6):
     return result
 
 
+def tile_offsets(length, size, step):
+    """Offsets of the windows that slice_tile emits along one axis
+    Args:
+        length (int): the extent of the image along the axis
+        size (int): the size of the window along the axis
+        step (int): the distance between consecutive windows
+    Returns:
+        np.array of window starting offsets"""
+    return np.arange(0, length - size + 1, step)
+
+
 def slices_metadata(imgf, img_path, mask_path, size=(512, 512), overlap=6):
     """
     Write geometry and source information to metadata
@@ -49,22 +65,23 @@ def slices_metadata(imgf, img_path, mask_path, size=(512, 512), overlap=6):
 def slice_polys(imgf, size=(512, 512), overlap=6):
     """
     Get Polygons Corresponding to Slices
+
+    The footprints are the full windows emitted by slice_tile, in the same
+    order, mapped to coordinates through the raster's affine transform.
     """
-    ix_row = np.arange(0, imgf.meta["height"], size[0] - overlap)
-    ix_col = np.arange(0, imgf.meta["width"], size[1] - overlap)
-    lats = np.linspace(imgf.bounds.bottom, imgf.bounds.top, imgf.meta["height"])
-    longs = np.linspace(imgf.bounds.left, imgf.bounds.right, imgf.meta["width"])
-
-    polys = []
-    for i in range(len(ix_row) - 1):
-        for j in range(len(ix_col) - 1):
-            box = shapely.geometry.box(
-                longs[ix_col[j]],
-                lats[ix_row[i]],
-                longs[ix_col[j + 1]],
-                lats[ix_row[i + 1]],
-            )
-            polys.append(box)
+    rows, cols = tile_grid(imgf, size, overlap)
+    rows, cols = [x.ravel() for x in np.meshgrid(rows, cols, indexing="ij")]
+
+    # pixel coordinates of each window's corners, then map them all at once
+    px = np.stack([cols, cols + size[1], cols + size[1], cols], axis=-1)
+    py = np.stack([rows, rows, rows + size[0], rows + size[0]], axis=-1)
+    t = imgf.transform
+    corners = np.stack([t.a * px + t.b * py + t.c, t.d * px + t.e * py + t.f], axis=-1)
+
+    if hasattr(shapely, "polygons"):
+        polys = shapely.polygons(corners)
+    else:
+        polys = [shapely.geometry.Polygon(c) for c in corners]
 
     return GeoDataFrame(geometry=polys, crs=imgf.meta["crs"].to_string())
 
@@ -73,19 +90,215 @@ def slice_pair(img, mask, **kwargs):
     """
     Slice an image / mask pair
     """
-    # maskout areas with nans
-    nan_mask = np.isnan(img[:, :, 0])
-    nan_mask = np.expand_dims(nan_mask, axis=2)
-    nan_mask = np.repeat(nan_mask, mask.shape[-1], axis=2)
-    mask[nan_mask] = 0
+    # maskout areas with nans, across all mask channels
+    np.copyto(mask, 0, where=np.isnan(img[:, :, :1]))
 
     img_slices = slice_tile(img, **kwargs)
     mask_slices = slice_tile(mask, **kwargs)
     return img_slices, mask_slices
 
 
+def tile_grid(imgf, size=(512, 512), overlap=6):
+    """Row and column offsets of the tiles emitted by slice_tile
+
+    Args:
+        imgf(rasterio.DatasetReader): the opened raw image tiff
+    Returns:
+        (rows, cols) tuple of np.arrays with the window starting offsets
+    """
+    step = size[0] - overlap
+    rows = tile_offsets(imgf.meta["height"], size[0], step)
+    cols = tile_offsets(imgf.meta["width"], size[1], step)
+    return rows, cols
+
+
+def slice_stats(img, mask, size=(512, 512), overlap=6, channel_stats=False):
+    """Compute statistics for all the slices of an image / mask pair
+
+    The statistics are reductions over the strided windows of view_as_windows,
+    so no per-slice copies are made.
+
+    Args:
+        img (np.array): image to be sliced
+        mask (np.array): mask to be sliced
+        channel_stats (bool): Also compute the min and max of each image
+          channel, ignoring nans
+    Returns:
+        dict of np.arrays with one value per slice, in the order of slice_tile
+    """
+    step = size[0] - overlap
+    windows = lambda x: view_as_windows(x, (size[0], size[1], x.shape[2]), step)[:, :, 0]
+    img_windows, mask_windows = windows(img), windows(mask)
+    valid_windows = windows(~np.isnan(img))
+
+    axes = (2, 3, 4)
+    n_values = size[0] * size[1] * img.shape[2]
+    n_slices = img_windows.shape[0] * img_windows.shape[1]
+    img_sum = np.sum(img_windows, axis=axes, dtype=np.float64, where=valid_windows)
+    n_valid = valid_windows.sum(axis=axes, dtype=np.intp)
+    mask_mean = mask_windows.mean(axis=(2, 3)).reshape(n_slices, -1)
+
+    stats = {f"mask_mean_{i}": mask_mean[:, i] for i in range(mask_mean.shape[1])}
+    stats["img_mean"] = img_sum.ravel() / n_values
+    stats["img_nan_frac"] = 1 - n_valid.ravel() / n_values
+    if channel_stats:
+        img_min = np.fmin.reduce(img_windows, axis=(2, 3)).reshape(n_slices, -1)
+        img_max = np.fmax.reduce(img_windows, axis=(2, 3)).reshape(n_slices, -1)
+        for i in range(img.shape[2]):
+            stats[f"img_min_{i}"] = img_min[:, i]
+            stats[f"img_max_{i}"] = img_max[:, i]
+
+    return stats
+
+
+def stream_pair(imgf, mask_path, border_path="", size=(512, 512), overlap=6,
+                rows=None):
+    """Read an image / mask pair one row of tiles at a time
+
+    Only the strip of rows covered by the current row of tiles is read, using
+    a rasterio window for the image and memory mapped reads for the mask and
+    border, so memory stays proportional to one row of tiles.
+
+    Args:
+        imgf(rasterio.DatasetReader): the opened raw image tiff
+        mask_path(String): the path to the mask array
+        border_path(String): the path to the border array
+        rows(range): The indices of the rows of tiles to read. Defaults to
+          all rows.
+    Returns:
+        generator of (img, mask) strips, one per row of tiles
+    """
+    mask = np.load(mask_path, mmap_mode="r")
+    border = np.load(border_path, mmap_mode="r") if border_path else None
+    row_offsets, _ = tile_grid(imgf, size, overlap)
+    if rows is not None:
+        row_offsets = row_offsets[rows.start:rows.stop]
+
+    for row in row_offsets:
+        window = Window(0, row, imgf.meta["width"], size[0])
+        img = imgf.read(window=window).transpose(1, 2, 0)
+        if border is not None:
+            img = clip_image_(img, border[row:(row + size[0])])
+        yield img, np.array(mask[row:(row + size[0])])
+
+
+def write_slices(img_path, mask_path, out_dir, border_path='',
+                 out_base="slice", stream=False, rows=None, verbose=True,
+                 shard_size=None, channel_stats=False, filter_perc=None,
+                 filter_channel=None, img_dtype=None, nodata=None,
+                 pack_masks=False, channel_major=False, **kwargs):
+    """Write sliced images and masks to numpy arrays, returning their stats
+
+    Args:
+        img_path(String): the path to the raw image tiff
+        mask_path(String): the paths to the mask array
+        border_path(String): the path to the border array
+        out_base(String): The basenames for all the output numpy files
+        out_dir(String): The directory to which all the results will be stored
+        stream(bool): Read and write one row of tiles at a time, instead of
+          loading the full image and mask into memory
+        rows(range): Only write the slices in these rows of tiles. Implies
+          stream.
+        verbose(bool): Show a progress bar
+        shard_size(int): If given, pack the slices into shards with this many
+          slices each, instead of writing one .npy file per slice
+        channel_stats(bool): Also record the min and max of each image channel
+        filter_perc([float]): The minimum percentages 1's in the
+          filter_channels needed for a slice to be written, as in
+          process_slices_funs.filter_directory. One per filter_channel;
+          defaults to 0.2 for each.
+        filter_channel([int]): The channels to do the filtering on. If None,
+          all slices are written.
+        img_dtype(str): If given, the dtype in which to store the image
+          slices, e.g., "float16" or "uint16". Integer dtypes need integer
+          valued images; see storage.make_encoding for the precision of each.
+        nodata(float): The value standing for NaN in integer image slices
+        pack_masks(bool): Store the mask slices packed to one bit per value
+        channel_major(bool): Store the image slices as (C, H, W), so that
+          loaders can read only the channels they use
+    Returns:
+        pd.DataFrame of slice paths and statistics, indexed by slice number.
+        Slices that failed the filter are flagged in the filtered column, and
+        have no paths.
+    """
+    if filter_channel is not None:
+        if filter_perc is None:
+            filter_perc = [0.2] * len(filter_channel)
+        if len(filter_perc) != len(filter_channel):
+            raise ValueError("filter_perc needs one percentage per filter_channel.")
+
+    imgf = rasterio.open(img_path)
+    row_offsets, col_offsets = tile_grid(imgf, **kwargs)
+    if rows is None:
+        rows = range(len(row_offsets))
+
+    if stream or len(rows) < len(row_offsets):
+        pairs = stream_pair(imgf, mask_path, border_path, rows=rows, **kwargs)
+    else:
+        img = imgf.read().transpose(1, 2, 0)
+        mask = np.load(mask_path)
+        if border_path:
+            img = clip_image(img, border_path)
+        pairs = [(img, mask)]
+
+    size = kwargs.get("size", (512, 512))
+    mask_shape = (size[0], size[1], np.load(mask_path, mmap_mode="r").shape[2])
+    encoding = make_encoding(img_dtype, nodata, pack_masks, mask_shape, channel_major)
+    if encoding is not None:
+        write_encoding(out_dir, encoding)
+
+    # loop over slices for individual tile / mask pairs
+    ks = range(rows.start * len(col_offsets), rows.stop * len(col_offsets))
+    progress = tqdm(total=len(ks), disable=not verbose)
+    writer = None
+    if shard_size:
+        prefix = out_base if len(rows) == len(row_offsets) else f"{out_base}_{rows.start}"
+        writer = ShardWriter(out_dir, prefix, shard_size)
+
+    k, slice_paths, stats = ks.start, [], []
+    for img, mask in pairs:
+        img_slices, mask_slices = slice_pair(img, mask, **kwargs)
+        stats.append(slice_stats(img, mask, channel_stats=channel_stats, **kwargs))
+        keep = np.ones(len(img_slices), dtype=bool)
+        if filter_channel is not None:
+            keep = filter_mask(pd.DataFrame(stats[-1]), filter_perc, filter_channel).values
+        stats[-1]["filtered"] = ~keep
+
+        for img_slice, mask_slice, keep_ in zip(img_slices, mask_slices, keep):
+            if not keep_:
+                slice_paths.append({"img_slice": None, "mask_slice": None})
+                progress.update()
+                k += 1
+                continue
+
+            img_slice, mask_slice = encode_slice(img_slice, mask_slice, encoding)
+            img_slice_path = Path(out_dir, f"{out_base}_img_{k:03}.npy")
+            mask_slice_path = Path(out_dir, f"{out_base}_mask_{k:03}.npy")
+            if writer is not None:
+                writer.write(img_slice_path.name, img_slice, mask_slice_path.name, mask_slice)
+            else:
+                np.save(img_slice_path, img_slice)
+                np.save(mask_slice_path, mask_slice)
+
+            slice_paths.append({"img_slice": str(img_slice_path), "mask_slice": str(mask_slice_path)})
+            progress.update()
+            k += 1
+
+    progress.close()
+    if writer is not None:
+        writer.close()
+
+    result = pd.DataFrame(slice_paths, index=ks)
+    for col in (stats[0] if stats else {}):
+        result[col] = np.concatenate([s[col] for s in stats])
+    return result
+
+
 def write_pair_slices(img_path, mask_path, out_dir, border_path='',
-                      out_base="slice",**kwargs):
+                      out_base="slice", stream=False, shard_size=None,
+                      channel_stats=False, filter_perc=None,
+                      filter_channel=None, img_dtype=None, nodata=None,
+                      pack_masks=False, channel_major=False, **kwargs):
     """ Write sliced images and masks to numpy arrays
 
     Args:
@@ -94,35 +307,111 @@ def write_pair_slices(img_path, mask_path, out_dir, border_path='',
         border_path(String): teh path to the border array
         output_base(String): The basenames for all the output numpy files
         out_dir(String): The directory to which all the results will be stored
+        stream(bool): Read and write one row of tiles at a time, instead of
+          loading the full image and mask into memory
+        shard_size(int): If given, pack the slices into shards with this many
+          slices each, instead of writing one .npy file per slice
+        channel_stats(bool): Also record the min and max of each image channel
+        filter_perc([float]): The minimum percentages 1's in the
+          filter_channels needed for a slice to be written. Defaults to 0.2
+          for each filter_channel.
+        filter_channel([int]): The channels to do the filtering on. If None,
+          all slices are written.
+        img_dtype(str): If given, the dtype in which to store the image slices
+        nodata(float): The value standing for NaN in integer image slices
+        pack_masks(bool): Store the mask slices packed to one bit per value
+        channel_major(bool): Store the image slices as (C, H, W)
     Returns:
         Writes a csv to metadata path
     """
+    stats = write_slices(img_path, mask_path, out_dir, border_path, out_base,
+                         stream, shard_size=shard_size,
+                         channel_stats=channel_stats, filter_perc=filter_perc,
+                         filter_channel=filter_channel, img_dtype=img_dtype,
+                         nodata=nodata, pack_masks=pack_masks,
+                         channel_major=channel_major, **kwargs)
     imgf = rasterio.open(img_path)
-    img = imgf.read().transpose(1, 2, 0)
-    mask = np.load(mask_path)
-    if border_path:
-        img = clip_image(img, border_path)
-    img_slices, mask_slices = slice_pair(img, mask, **kwargs)
     metadata = slices_metadata(imgf, img_path, mask_path, **kwargs)
+    return pd.concat([metadata, stats], axis=1)
 
-    # loop over slices for individual tile / mask pairs
-    slice_stats = []
-    for k in tqdm(range(len(img_slices))):
-        img_slice_path = Path(out_dir, f"{out_base}_img_{k:03}.npy")
-        mask_slice_path = Path(out_dir, f"{out_base}_mask_{k:03}.npy")
-        np.save(img_slice_path, img_slices[k])
-        np.save(mask_slice_path, mask_slices[k])
-
-        # update metadata
-        stats = {"img_slice": str(img_slice_path), "mask_slice": str(mask_slice_path)}
-        img_slice_mean = np.nan_to_num(img_slices[k]).mean()
-        mask_mean = mask_slices[k].mean(axis=(0, 1))
-        stats.update({f"mask_mean_{i}": v for i, v in enumerate(mask_mean)})
-        stats.update({"img_mean": img_slice_mean})
-        slice_stats.append(stats)
-
-    slice_stats = pd.DataFrame(slice_stats)
-    return pd.concat([metadata, slice_stats], axis=1)
+
+def write_pairs_parallel(img_paths, mask_paths, out_dir, border_paths=None,
+                         out_bases=None, n_workers=None, rows_per_task=None,
+                         shard_size=None, channel_stats=False,
+                         filter_perc=None, filter_channel=None,
+                         img_dtype=None, nodata=None, pack_masks=False,
+                         channel_major=False, **kwargs):
+    """Write slices for many image / mask pairs over a pool of processes
+
+    Args:
+        img_paths(List): A list of Strings of the paths to the raw image tiffs
+        mask_paths(List): A list of Strings of the paths to the mask arrays
+        out_dir(String): The directory to which all the results will be stored
+        border_paths(List): A list of Strings of the paths to the border arrays
+        out_bases(List): The basenames for the output numpy files of each
+          pair. Defaults to slice_{k}.
+        n_workers(int): The number of worker processes. Defaults to the number
+          of cpus.
+        rows_per_task(int): If given, split each image into tasks of this
+          many rows of tiles, so that one large scene is spread over several
+          workers. Implies streaming reads.
+        shard_size(int): If given, pack the slices into shards with this many
+          slices each, instead of writing one .npy file per slice
+        channel_stats(bool): Also record the min and max of each image channel
+        filter_perc([float]): The minimum percentages 1's in the
+          filter_channels needed for a slice to be written. Defaults to 0.2
+          for each filter_channel.
+        filter_channel([int]): The channels to do the filtering on. If None,
+          all slices are written.
+        img_dtype(str): If given, the dtype in which to store the image slices
+        nodata(float): The value standing for NaN in integer image slices
+        pack_masks(bool): Store the mask slices packed to one bit per value
+        channel_major(bool): Store the image slices as (C, H, W)
+    Returns:
+        GeoDataFrame with the metadata of all the slices, in the order of
+        img_paths.
+    """
+    if not border_paths:
+        border_paths = [""] * len(img_paths)
+    if out_bases is None:
+        out_bases = [f"slice_{k}" for k in range(len(img_paths))]
+
+    tasks = []
+    for k, img_path in enumerate(img_paths):
+        n_rows = len(tile_grid(rasterio.open(img_path), **kwargs)[0])
+        step = rows_per_task or max(n_rows, 1)
+        for start in range(0, max(n_rows, 1), step):
+            tasks.append((k, range(start, min(start + step, n_rows))))
+
+    start_time = time.time()
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [
+            executor.submit(
+                write_slices, img_paths[k], mask_paths[k], out_dir,
+                border_paths[k], out_bases[k], rows_per_task is not None,
+                rows, verbose=False, shard_size=shard_size,
+                channel_stats=channel_stats, filter_perc=filter_perc,
+                filter_channel=filter_channel, img_dtype=img_dtype,
+                nodata=nodata, pack_masks=pack_masks,
+                channel_major=channel_major, **kwargs
+            )
+            for k, rows in tasks
+        ]
+        task_stats = [f.result() for f in tqdm(futures)]
+
+    # merge the per-task results, in the order of the input pairs
+    metadata = []
+    for k, img_path in enumerate(img_paths):
+        stats = pd.concat([s for (j, _), s in zip(tasks, task_stats) if j == k])
+        meta = slices_metadata(rasterio.open(img_path), img_path, mask_paths[k], **kwargs)
+        metadata.append(pd.concat([meta, stats], axis=1))
+
+    n_slices = sum(len(s) for s in task_stats)
+    n_written = sum((~s["filtered"]).sum() for s in task_stats)
+    elapsed = time.time() - start_time
+    print(f"sliced {n_slices} tiles ({n_written} written) in {elapsed:.1f}s "
+          f"({n_slices / elapsed:.1f} slices/sec)")
+    return pd.concat(metadata, axis=0)
 
 def clip_image(img, shp_path):
     """Clip an image to the extent of an mask.
@@ -132,9 +421,13 @@ def clip_image(img, shp_path):
     Returns:
         The clipped images, with non-valid points as numpy.nan
     """
-    mask = np.load(shp_path)
-    mask = np.repeat(mask, img.shape[-1], axis=2)
-    img[mask == 0] = np.nan
+    return clip_image_(img, np.load(shp_path))
+
+
+def clip_image_(img, border):
+    """Internal helper for clip_image, given the loaded border mask
+    """
+    np.copyto(img, np.nan, where=(border == 0))
     return img
 
 def plot_slices(slice_dir, processed=False, n_cols=3, div=3000, n_examples=5):
@@ -144,8 +437,8 @@ def plot_slices(slice_dir, processed=False, n_cols=3, div=3000, n_examples=5):
     _, ax = plt.subplots(n_examples, n_cols, figsize=(15,15))
     for i in range(n_examples):
         index = np.random.randint(0, len(files))
-        img = np.load(files[index])
-        mask = np.load(str(files[index]).replace("img", "mask"))
+        img = load_slice(files[index])
+        mask = load_slice(str(files[index]).replace("img", "mask"))
 
         if not processed:
             ax[i, 0].imshow(np.nan_to_num(img[:, :, [0, 1, 2]]) / div)
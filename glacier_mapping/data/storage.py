@@ -0,0 +1,563 @@
+#!/usr/bin/env python
+"""
+On-Disk Storage of Slices
+
+Slices are either saved as one .npy file per image / mask, or packed into a
+few large shard files per directory. A sharded directory contains, for each
+writer,
+
+* {prefix}.index.json: the dtype and shape of the image and mask slices, the
+  list of shards, and the shard and offset of every slice.
+* {prefix}_{shard}.img.bin / {prefix}_{shard}.mask.bin: the raw slices of one
+  shard, stacked along the first axis so they can be memory mapped.
+
+Slices inside shards keep the path they would have had as a .npy file, so
+metadata, filtering, and splitting code can keep referring to them by path.
+
+A split directory may also just hold a manifest.csv listing the paths of its
+image and mask slices, instead of the slices themselves.
+
+Slices can be stored compactly, with images in a smaller dtype (e.g.,
+float16, or the 16 bit integers of the raw bands with a nodata value in
+place of NaN) and masks packed to one bit per value. An encoding.json in
+the directory describes the encoding, and load_slice decodes to float32
+images and uint8 masks. Images can also be stored channel major, (C, H, W),
+so that reading a few of the channels only reads their part of the file.
+"""
+from functools import lru_cache
+from pathlib import Path
+import csv
+import json
+import os
+import numpy as np
+
+INDEX_SUFFIX = ".index.json"
+MANIFEST_NAME = "manifest.csv"
+ENCODING_NAME = "encoding.json"
+
+
+class ShardWriter:
+    """Append image / mask slices to the shards of a directory
+
+    Usage::
+
+        with ShardWriter(out_dir, "slice_0") as writer:
+            writer.write("slice_0_img_000.npy", img, "slice_0_mask_000.npy", mask)
+    """
+
+    def __init__(self, out_dir, prefix="slices", shard_size=1024):
+        """Initialize writer.
+
+        Args:
+            out_dir(str): The directory in which to write the shards
+            prefix(str): The basename of the shard and index files. Writers
+              working on the same directory need distinct prefixes.
+            shard_size(int): The maximum number of slices per shard
+        """
+        self.out_dir = Path(out_dir)
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self.index = {"img": None, "mask": None, "shards": [], "records": []}
+        self._files = None
+
+    def _next_shard(self):
+        self._close_shard()
+        s = len(self.index["shards"])
+        shard = {k: f"{self.prefix}_{s:03}.{k}.bin" for k in ["img", "mask"]}
+        shard["length"] = 0
+        self.index["shards"].append(shard)
+        self._files = {k: open(self.out_dir / shard[k], "wb") for k in ["img", "mask"]}
+
+    def _close_shard(self):
+        if self._files is not None:
+            for f in self._files.values():
+                f.close()
+            self._files = None
+
+    def write(self, img_name, img, mask_name, mask):
+        """Append one image / mask pair
+
+        Args:
+            img_name(str): The file name identifying the image slice
+            img(np.array): The image slice
+            mask_name(str): The file name identifying the mask slice
+            mask(np.array): The mask slice
+        """
+        if self._files is None or self.index["shards"][-1]["length"] == self.shard_size:
+            self._next_shard()
+
+        shard = self.index["shards"][-1]
+        for k, x in [("img", img), ("mask", mask)]:
+            spec = {"dtype": x.dtype.str, "shape": list(x.shape)}
+            if self.index[k] is None:
+                self.index[k] = spec
+            elif self.index[k] != spec:
+                raise ValueError(f"Expected {k} slice with {self.index[k]}, got {spec}.")
+            np.ascontiguousarray(x).tofile(self._files[k])
+
+        self.index["records"].append({
+            "img": img_name,
+            "mask": mask_name,
+            "shard": len(self.index["shards"]) - 1,
+            "offset": shard["length"],
+        })
+        shard["length"] += 1
+
+    def close(self):
+        """Close the current shard and write the index"""
+        self._close_shard()
+        index_path = self.out_dir / f"{self.prefix}{INDEX_SUFFIX}"
+        tmp_path = index_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, index_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ShardReader:
+    """Memory mapped access to all the sharded slices in a directory
+
+    Indexing the i^th element returns views of the underlying image and mask,
+    without copying them out of the shard.
+    """
+
+    def __init__(self, folder_path):
+        """Initialize reader.
+
+        Args:
+            folder_path(str): A path to a directory containing shards
+        """
+        self.folder_path = Path(folder_path)
+        self.indices = [
+            json.load(open(p, "r"))
+            for p in sorted(self.folder_path.glob(f"*{INDEX_SUFFIX}"))
+        ]
+
+        self.records, self.lookup = [], {}
+        for i, index in enumerate(self.indices):
+            for record in index["records"]:
+                self.lookup[record["img"]] = ("img", len(self.records))
+                self.lookup[record["mask"]] = ("mask", len(self.records))
+                self.records.append((i, record["shard"], record["offset"]))
+
+        self.img_names = [
+            r["img"] for index in self.indices for r in index["records"]
+        ]
+        self.mask_names = [
+            r["mask"] for index in self.indices for r in index["records"]
+        ]
+        self._arrays = {}
+
+    def _array(self, i, shard, kind):
+        key = (i, shard, kind)
+        if key not in self._arrays:
+            index = self.indices[i]
+            self._arrays[key] = np.memmap(
+                self.folder_path / index["shards"][shard][kind],
+                dtype=np.dtype(index[kind]["dtype"]),
+                mode="c",
+                shape=(index["shards"][shard]["length"], *index[kind]["shape"]),
+            )
+        return self._arrays[key]
+
+    def shard_ids(self):
+        """The (index, shard) each slice belongs to, in the order of the slices"""
+        return [(i, shard) for i, shard, _ in self.records]
+
+    def load(self, name):
+        """Get a view of a slice given its file name"""
+        kind, position = self.lookup[Path(name).name]
+        i, shard, offset = self.records[position]
+        return self._array(i, shard, kind)[offset]
+
+    def __getitem__(self, position):
+        i, shard, offset = self.records[position]
+        return self._array(i, shard, "img")[offset], self._array(i, shard, "mask")[offset]
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getstate__(self):
+        # memory maps are re-opened lazily, rather than pickled as copies
+        state = self.__dict__.copy()
+        state["_arrays"] = {}
+        return state
+
+
+def is_sharded(folder_path):
+    """Check whether a directory contains sharded slices"""
+    return any(Path(folder_path).glob(f"*{INDEX_SUFFIX}"))
+
+
+@lru_cache(maxsize=32)
+def _open_shards(folder_path, signature):
+    return ShardReader(folder_path)
+
+
+def open_shards(folder_path):
+    """Get a (cached) ShardReader for a directory
+
+    The cache is invalidated whenever an index in the directory changes.
+    """
+    signature = tuple(
+        (p.name, p.stat().st_mtime_ns)
+        for p in sorted(Path(folder_path).glob(f"*{INDEX_SUFFIX}"))
+    )
+    return _open_shards(str(folder_path), signature)
+
+
+def load_slice(path, mmap_mode=None, decode=True, channels=None):
+    """Load a slice, whether saved as its own .npy file or inside a shard
+
+    Args:
+        path(str): The path of the slice
+        mmap_mode(str): If given, the memory map mode with which to open a
+          .npy file, and slices inside a shard are returned as views instead
+          of copies
+        decode(bool): Whether to decode slices stored with the encoding of
+          their directory
+        channels([int]): If given, only load these channels of an image. When
+          images are stored channel major, only these channels are read.
+
+    Return:
+        The slice as a numpy array
+    """
+    path = Path(path)
+    encoding = read_encoding(path.parent)
+    x = read_slice(path, encoding, mmap_mode, channels)
+    return decode_slice(x, encoding, slice_kind(path)) if decode else x
+
+
+def read_slice(path, encoding=None, mmap_mode=None, channels=None):
+    """Read a slice as stored, given the encoding of its directory
+
+    Unlike load_slice, this neither looks up the encoding nor checks whether
+    the path exists, so that a reader that already knows the encoding (e.g.,
+    GlacierDataset) makes no metadata calls besides opening the file.
+
+    Args:
+        path(str): The path of the slice, a .npy file or inside a shard
+        encoding(dict): The encoding of its directory, or None
+        mmap_mode(str): As in load_slice
+        channels([int]): As in load_slice
+
+    Return:
+        The stored slice, not decoded
+    """
+    path = Path(path)
+    try:
+        if channels is not None and is_channel_major(encoding):
+            return read_channels(path, channels)
+        x = np.load(path, mmap_mode=mmap_mode)
+    except FileNotFoundError:
+        x = open_shards(path.parent).load(path.name)
+    x = select_channels(x, channels, encoding)
+    if mmap_mode is None and (isinstance(x, np.memmap) or not x.flags.owndata):
+        x = np.array(x)
+    return x
+
+
+def make_encoding(img_dtype=None, nodata=None, pack_masks=False, mask_shape=None,
+                  channel_major=False):
+    """Specify a compact encoding of slices
+
+    Args:
+        img_dtype(str): The dtype in which to store images, e.g., "float16",
+          or "uint16" for raw bands with integer values. None keeps the
+          dtype of the image. Integer dtypes are lossless, and encode_slice
+          raises on any value that is not an integer (e.g., the NDWI / NDSI
+          / NDVI bands in [-1, 1]). float16 keeps 11 significant bits: above
+          2048 it no longer holds every integer, and above 16384 (within the
+          range of raw 16 bit bands) representable values are 16 apart.
+        nodata(float): The value standing for NaN in integer images, which
+          no valid pixel may hold. Defaults to the largest value of the dtype.
+        pack_masks(bool): Whether to store binary masks with np.packbits
+        mask_shape(tuple): The shape of the mask slices, needed to unpack them
+        channel_major(bool): Whether to store images as (C, H, W), so that
+          reading some of the channels only touches their part of the file
+
+    Return:
+        The encoding as a dictionary, or None if slices are stored as is
+    """
+    if img_dtype is None and not pack_masks and not channel_major:
+        return None
+
+    img = None
+    if img_dtype is not None or channel_major:
+        dtype = None if img_dtype is None else np.dtype(img_dtype)
+        if dtype is not None and dtype.kind in "iu" and nodata is None:
+            nodata = int(np.iinfo(dtype).max)
+        img = {
+            "dtype": None if dtype is None else dtype.str,
+            "nodata": nodata if dtype is not None and dtype.kind in "iu" else None,
+            "channel_major": channel_major,
+        }
+    mask = {"packbits": True, "shape": list(mask_shape)} if pack_masks else None
+    return {"img": img, "mask": mask}
+
+
+def encode_slice(img, mask, encoding):
+    """Encode an image / mask pair for storage
+
+    Args:
+        img(np.array): The image slice, with NaN where there is no data
+        mask(np.array): The binary mask slice
+        encoding(dict): An encoding from make_encoding, or None
+
+    Return:
+        The encoded image and mask
+    """
+    if encoding is None:
+        return img, mask
+
+    if encoding["img"] is not None:
+        if encoding["img"]["dtype"] is not None:
+            dtype = np.dtype(encoding["img"]["dtype"])
+            if dtype.kind in "iu":
+                info = np.iinfo(dtype)
+                nodata = encoding["img"]["nodata"]
+                if np.any(img == nodata):
+                    raise ValueError(f"Image values equal to nodata ({nodata}) decode as NaN.")
+                img = np.nan_to_num(img, nan=nodata)
+                if np.any(img != np.rint(img)):
+                    raise ValueError(f"Only images with integer values can be stored as {dtype}.")
+                if img.min(initial=info.max) < info.min or img.max(initial=info.min) > info.max:
+                    raise ValueError(f"Image values out of the range of {dtype}.")
+            elif np.nanmax(np.abs(img), initial=0) > np.finfo(dtype).max:
+                raise ValueError(f"Image values out of the range of {dtype}.")
+            img = img.astype(dtype)
+        if encoding["img"]["channel_major"]:
+            img = np.ascontiguousarray(np.moveaxis(img, -1, 0))
+
+    if encoding["mask"] is not None:
+        if mask.max(initial=0) > 1:
+            raise ValueError("Only binary masks can be packed.")
+        mask = np.packbits(mask.astype(bool), axis=None)
+    return img, mask
+
+
+def slice_kind(path):
+    """Whether a slice path is of an image ("img") or a mask ("mask")"""
+    return "mask" if "mask" in Path(path).name else "img"
+
+
+def is_channel_major(encoding):
+    """Whether an encoding stores images as (C, H, W)"""
+    return encoding is not None and encoding["img"] is not None and encoding["img"]["channel_major"]
+
+
+def read_channels(path, channels):
+    """Read some of the channels of a channel major .npy image slice
+
+    Each channel is read with its own seek and read, rather than through a
+    memory map, whose readahead would also read the channels in between.
+
+    Args:
+        path(str): The path of the .npy slice, stored as (C, H, W)
+        channels([int]): The channels to read
+
+    Return:
+        The stored (len(channels), H, W) image
+    """
+    with open(path, "rb") as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        if fortran_order:
+            return np.array(np.load(path, mmap_mode="r")[channels])
+
+        offset = f.tell()
+        x = np.empty((len(channels),) + tuple(shape[1:]), dtype=dtype)
+        for k, channel in enumerate(channels):
+            f.seek(offset + int(channel) * x[k].nbytes)
+            f.readinto(x[k])
+    return x
+
+
+def select_channels(x, channels, encoding):
+    """Subset the channels of a stored image slice, before decoding it
+
+    For channel major images, this indexes the first axis, so a memory mapped
+    slice only reads the selected channels.
+
+    Args:
+        x(np.array): The stored image slice
+        channels([int]): The channels to keep. None keeps all of them.
+        encoding(dict): The encoding of its directory, or None
+
+    Return:
+        The stored image with only the selected channels
+    """
+    if channels is None:
+        return x
+    if is_channel_major(encoding):
+        return x[channels]
+    return x[..., channels]
+
+
+def decode_slice(x, encoding, kind="img"):
+    """Decode a slice stored with an encoding
+
+    Images that do not match the encoding, e.g., ones that were
+    postprocessed and saved over the encoded slices, are returned as is.
+
+    Args:
+        x(np.array): The stored slice
+        encoding(dict): The encoding of its directory, or None
+        kind(str): "img" or "mask"
+
+    Return:
+        The decoded slice: a float32 (H, W, C) image with NaN where there is no
+        data, or a uint8 mask
+    """
+    if encoding is None:
+        return x
+
+    spec = encoding[kind]
+    if kind == "mask":
+        if spec is None or x.ndim != 1:
+            return x
+        shape = spec["shape"]
+        return np.unpackbits(x, count=int(np.prod(shape))).reshape(shape)
+
+    if spec is None or (spec["dtype"] is not None and x.dtype != np.dtype(spec["dtype"])):
+        return x
+    if spec["channel_major"]:
+        if x.ndim != 3:
+            return x
+        result = np.empty(x.shape[1:] + x.shape[:1], dtype=np.float32)
+        result[...] = np.moveaxis(x, 0, -1)
+        nodata_mask = lambda: np.moveaxis(x == spec["nodata"], 0, -1)
+    else:
+        result = x.astype(np.float32)
+        nodata_mask = lambda: x == spec["nodata"]
+    if spec["nodata"] is not None:
+        np.copyto(result, np.nan, where=nodata_mask())
+    return result
+
+
+def read_encoding(folder_path):
+    """Read the (cached) encoding of the slices in a directory, if any"""
+    path = Path(folder_path, ENCODING_NAME)
+    try:
+        mtime = path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+    return _read_encoding(str(path), mtime)
+
+
+@lru_cache(maxsize=32)
+def _read_encoding(path, mtime):
+    return json.load(open(path, "r"))
+
+
+def write_encoding(folder_path, encoding):
+    """Write the encoding of the slices in a directory"""
+    path = Path(folder_path, ENCODING_NAME)
+    tmp_path = path.with_name(f".{ENCODING_NAME}.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(encoding, f)
+    os.replace(tmp_path, path)
+
+
+def copy_encoding(source_dir, target_dir):
+    """Copy the encoding of a directory of slices to another, if it has one"""
+    encoding = read_encoding(source_dir)
+    if encoding is not None:
+        write_encoding(target_dir, encoding)
+
+
+def save_slice(path, x):
+    """Save a slice to a .npy file, replacing whatever is at path
+
+    The slice is written to a temporary file which is then renamed, so when
+    path is a hard or symbolic link, the link is replaced rather than the
+    file it points to being overwritten.
+
+    Args:
+        path(str): The path of the slice
+        x(np.array): The slice to save
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.tmp.npy")
+    np.save(tmp_path, x)
+    os.replace(tmp_path, path)
+
+
+def read_manifest(folder_path):
+    """Read the image and mask paths listed in a split's manifest
+
+    Args:
+        folder_path(str): A path to a split directory written by reshuffle
+          with mode="manifest"
+    Return:
+        (img_paths, mask_paths) tuple of lists
+    """
+    img_paths, mask_paths = [], []
+    with open(Path(folder_path, MANIFEST_NAME), "r") as f:
+        for row in csv.DictReader(f):
+            img_paths.append(row["img"])
+            mask_paths.append(row["mask"])
+    return img_paths, mask_paths
+
+
+def write_manifest(folder_path, ids):
+    """Write a manifest listing the image and mask paths of a split
+
+    Args:
+        folder_path(str): The split directory
+        ids(list of dict): Dictionaries with keys "img" and "mask"
+    """
+    with open(Path(folder_path, MANIFEST_NAME), "w") as f:
+        writer = csv.DictWriter(f, fieldnames=["img", "mask"])
+        writer.writeheader()
+        for slice_id in ids:
+            writer.writerow({k: str(slice_id[k]) for k in ["img", "mask"]})
+
+
+def reshuffle_shards(split_ids, output_dir="output/", shard_size=1024):
+    """Write the sharded slices of each split into that split's own shards
+
+    Slices are read in shard order, so the source shards are scanned
+    sequentially.
+
+    Args:
+        split_ids(dict): Lists of {"img": path, "mask": path} dictionaries, for
+          each of train / dev / test
+        output_dir(str): Directory to place the split dataset
+        shard_size(int): The maximum number of slices per output shard
+    Return:
+        Target locations
+    """
+    target_locs = {k: [] for k in split_ids}
+    for split_type, ids in split_ids.items():
+        path = Path(output_dir, split_type)
+        os.makedirs(path, exist_ok=True)
+
+        def source_position(slice_id):
+            img_path = Path(slice_id["img"])
+            reader = open_shards(img_path.parent)
+            _, position = reader.lookup[img_path.name]
+            return str(img_path.parent), reader.records[position]
+
+        if ids:
+            copy_encoding(Path(ids[0]["img"]).parent, path)
+        with ShardWriter(path, "slices", shard_size) as writer:
+            for slice_id in sorted(ids, key=source_position):
+                img = load_slice(slice_id["img"], decode=False)
+                mask = load_slice(slice_id["mask"], decode=False)
+                img_name, mask_name = Path(slice_id["img"]).name, Path(slice_id["mask"]).name
+                writer.write(img_name, img, mask_name, mask)
+                target_locs[split_type].append({
+                    "img": (path / img_name).resolve(),
+                    "mask": (path / mask_name).resolve()
+                })
+
+    return target_locs
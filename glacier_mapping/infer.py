@@ -17,8 +17,8 @@ from shapely.ops import unary_union
 import skimage.measure
 from skimage.util.shape import view_as_windows
 from rasterio.windows import Window
-from .data.process_slices_funs import postprocess_tile
-from .models.frame import Framework
+from .data.process_slices_funs import ProcessPipeline
+from .models.frame import Framework, autocast
 
 
 def squash(x):
@@ -78,7 +78,8 @@ def merge_patches(patches, overlap):
     return result
 
 
-def inference(img, model, process_conf, overlap=0, infer_size=1024, device=None):
+def inference(img, model, process_conf, overlap=0, infer_size=1024, device=None,
+              amp_dtype=None):
     """Make predictions on an unprocessed tiff
 
     :param img: A (unprocessed) numpy array on which to do inference.
@@ -96,11 +97,13 @@ def inference(img, model, process_conf, overlap=0, infer_size=1024, device=None)
     :type infer_size: int
     :param device: The device (gpu or cpu) on which to run inference.
     :type device: torch.device
+    :param amp_dtype: If given (e.g., "bfloat16"), run the model under autocast
+      in this dtype, as with the amp_opts of training.
+    :type amp_dtype: string
     :return prediction: A segmentation mask of the same width and height as img.
     :type prediction: np.array
     """
     process_opts = Dict(yaml.safe_load(open(process_conf, "r")))
-    channels = process_opts.process_funs.extract_channel.img_channels
     if device is None:
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -117,18 +120,16 @@ def inference(img, model, process_conf, overlap=0, infer_size=1024, device=None)
 
     I, J, _, _, _, _ = slice_imgs.shape
     predictions = np.zeros((I, J, 1, slice_size[0], slice_size[1], 1))
-    patches = np.zeros((I, J, 1, slice_size[0], slice_size[1], len(channels)))
+    patches, _ = ProcessPipeline(process_opts.process_funs)(slice_imgs)
 
     for i in range(I):
         for j in range(J):
-            patch, _ = postprocess_tile(slice_imgs[i, j, 0], process_opts.process_funs)
-            patches[i, j, :] = patch
-            patch = np.transpose(patch, (2, 0, 1))
+            patch = np.transpose(patches[i, j, 0], (2, 0, 1))
             patch = torch.from_numpy(patch).float().unsqueeze(0)
 
-            with torch.no_grad():
+            with torch.no_grad(), autocast(device, amp_dtype):
                 patch = patch.to(device)
-                y_hat = model(patch).cpu().numpy()
+                y_hat = model(patch).float().cpu().numpy()
                 y_hat = 1 / (1 + np.exp(-y_hat))
                 predictions[i, j, 0] = np.transpose(y_hat, (0, 2, 3, 1))
 
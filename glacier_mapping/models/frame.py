@@ -5,6 +5,7 @@ Frame to Combine Model with Optimizer
 This wraps the model and optimizer objects needed in training, so that each
 training step can be concisely called with a single method (optimize).
 """
+from contextlib import nullcontext
 from pathlib import Path
 import os
 import torch
@@ -23,9 +24,17 @@ class Framework:
     """
 
     def __init__(self, loss_fn=None, model_opts=None, optimizer_opts=None,
-                 reg_opts=None, device=None):
+                 reg_opts=None, device=None, amp_opts=None):
         """
         Set Class Attrributes
+
+        amp_opts, e.g., {"enabled": True, "dtype": "bfloat16"}, runs the model
+        under autocast in that dtype (see the autocast function). With float16
+        on a gpu, gradients are scaled with a GradScaler.
+
+        model_opts.channels_last stores the model's weights and activations in
+        channels_last memory format, the layout of the (N, H, W, C) batches
+        from the loaders, so that batches reach the model without a copy.
         """
         if device is None:
             self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -44,7 +53,8 @@ class Framework:
         else:
             raise ValueError("Unknown model name")
 
-        self.model = model_def(**model_opts.args).to(self.device)
+        self.memory_format = torch.channels_last if model_opts.get("channels_last") else torch.contiguous_format
+        self.model = model_def(**model_opts.args).to(self.device, memory_format=self.memory_format)
         optimizer_def = getattr(torch.optim, optimizer_opts.name)
         self.optimizer = optimizer_def(self.model.parameters(), **optimizer_opts.args)
         self.lrscheduler = ReduceLROnPlateau(self.optimizer, "min",
@@ -52,6 +62,12 @@ class Framework:
                                              min_lr=1e-6)
         self.reg_opts = reg_opts
 
+        amp_opts = amp_opts or {}
+        self.amp_dtype = amp_opts.get("dtype", "bfloat16") if amp_opts.get("enabled") else None
+        autocast(self.device, self.amp_dtype)  # fail now if unsupported
+        self.scaler = None
+        if self.amp_dtype == "float16" and self.device.type == "cuda":
+            self.scaler = torch.cuda.amp.GradScaler()
 
     def optimize(self, x, y):
         """
@@ -59,20 +75,61 @@ class Framework:
 
         Args:
             X: raw training data
-            y: labels
+            y: labels, either masks or class index maps
         Return:
             optimization
         """
-        x = x.permute(0, 3, 1, 2).to(self.device)
-        y = y.permute(0, 3, 1, 2).to(self.device)
+        x, y = self.channel_first(x), self.channel_first(y)
 
         self.optimizer.zero_grad()
-        y_hat = self.model(x)
+        with autocast(self.device, self.amp_dtype):
+            y_hat = self.model(x)
+        # the loss is computed in float32, outside of autocast
+        y_hat = y_hat.float()
         loss = self.calc_loss(y_hat, y)
-        loss.backward()
-        self.optimizer.step()
+        if self.scaler is not None:
+            self.scaler.scale(loss).backward()
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+        else:
+            loss.backward()
+            self.optimizer.step()
+        return y_hat.permute(0, 2, 3, 1), loss.item()
+
+    def evaluate(self, x, y):
+        """
+        Predict a batch and compute its loss, without a gradient step
+
+        Args:
+            x: input x
+            y: labels, either masks or class index maps
+        Return:
+            Prediction, with channels last, and the loss
+        """
+        x, y = self.channel_first(x), self.channel_first(y)
+        with torch.no_grad():
+            with autocast(self.device, self.amp_dtype):
+                y_hat = self.model(x)
+            y_hat = y_hat.float()
+            loss = self.calc_loss(y_hat, y)
         return y_hat.permute(0, 2, 3, 1), loss.item()
 
+    def channel_first(self, x):
+        """
+        Move a (N, H, W, C) batch to the device, as a (N, C, H, W) tensor
+
+        This is a view of the batch. It is already in channels_last memory
+        format, so no copy is made when the model uses channels_last. Class
+        index maps (N, H, W) are only moved to the device.
+        """
+        x = x.to(self.device)
+        if x.ndim != 4:
+            return x
+        x = x.permute(0, 3, 1, 2)
+        if self.memory_format == torch.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        return x
+
     def val_operations(self, val_loss):
         """
         Update the LR Scheduler
@@ -101,9 +158,9 @@ class Framework:
             Prediction
 
         """
-        x = x.permute(0, 3, 1, 2).to(self.device)
-        with torch.no_grad():
-            return self.model(x).permute(0, 2, 3, 1)
+        x = self.channel_first(x)
+        with torch.no_grad(), autocast(self.device, self.amp_dtype):
+            return self.model(x).float().permute(0, 2, 3, 1)
 
     def segment(self, y_hat):
         """Predict a class given logits
@@ -139,7 +196,7 @@ class Framework:
 
         Args:
             y_hat: Prediction
-            y: Label
+            y: Label, a mask with channels first, or a map of class indices
 
         Return:
             Loss values
@@ -149,8 +206,9 @@ class Framework:
         y = y.to(self.device)
 
         if self.multi_class:
-            y = torch.argmax(y, dim=1)
-            y = torch.tensor(y, dtype=torch.long, device=self.device)
+            if y.ndim == y_hat.ndim:
+                y = torch.argmax(y, dim=1)
+            y = y.long()
 
         loss = self.loss_fn(y_hat, y)
 
@@ -169,9 +227,12 @@ class Framework:
     def metrics(self, y_hat, y, metrics_opts):
         """ Loop over metrics in train.yaml
 
+        These are the metrics of a single batch. ConfusionMatrix pools them
+        over an epoch.
+
         Args:
             y_hat: Predictions
-            y: Labels
+            y: Labels, masks or class index maps
             metrics_opts: Metrics specified in the train.yaml
 
         Return:
@@ -180,12 +241,37 @@ class Framework:
         """
         y_hat = y_hat.to(self.device)
         y = y.to(self.device)
+        if y.ndim == 3:
+            y = torch.nn.functional.one_hot(y.long(), self.num_classes)
 
         results = {}
         for k, metric in metrics_opts.items():
+            pred = y_hat
             if "threshold" in metric.keys():
-                y_hat = y_hat > metric["threshold"]
+                pred = y_hat > metric["threshold"]
 
             metric_fun = globals()[k]
-            results[k] = metric_fun(y_hat, y)
+            results[k] = metric_fun(pred, y)
         return results
+
+
+def autocast(device, dtype=None):
+    """Context in which a model runs in a lower precision dtype
+
+    Args:
+        device(torch.device): The device on which the model runs
+        dtype(str): "bfloat16" (supported on cpus, and recent gpus) or
+          "float16" (gpus). None runs in float32.
+
+    Return:
+        A torch autocast context, or a null context if dtype is None
+    """
+    if dtype is None:
+        return nullcontext()
+    device = torch.device(device)
+    if hasattr(torch, "autocast"):
+        return torch.autocast(device.type, dtype=getattr(torch, dtype))
+    if device.type == "cuda" and dtype == "float16":
+        # before torch 1.10, only float16 autocast on gpus is available
+        return torch.cuda.amp.autocast()
+    raise ValueError(f"autocast to {dtype} on {device.type} needs torch >= 1.10.")
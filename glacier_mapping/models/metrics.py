@@ -82,3 +82,101 @@ class diceloss(torch.nn.Module):
         dice = dice * torch.tensor(self.w).to(device=dice.device)
 
         return dice.sum()
+
+
+class ConfusionMatrix:
+    """Per-class confusion counts, accumulated on the device over an epoch
+
+    Every metric in metrics_opts is derived from the same counts of true
+    positives, predicted positives, and actual positives of each class, so
+    the pixels of a batch are reduced once per threshold, however many
+    metrics use it. The counts stay on the device until compute, which
+    returns the metrics pooled over all the pixels seen.
+
+    Usage::
+
+        confusion = ConfusionMatrix(conf.metrics_opts, frame.num_classes, frame.device)
+        for x, y in loader:
+            confusion.update(frame.segment(frame.infer(x)), y)
+        metrics = confusion.compute()
+    """
+
+    def __init__(self, metrics_opts, num_classes, device=None):
+        """Initialize counts.
+
+        Args:
+            metrics_opts(dict): The metrics to compute, e.g., {"IoU":
+              {"threshold": 0.4}}, as in train.yaml
+            num_classes(int): The number of output channels
+            device(torch.device): The device on which to accumulate
+        """
+        for k in metrics_opts:
+            if k not in POOLED_METRICS:
+                raise ValueError(f"Unknown metric {k}.")
+        self.metrics_opts = metrics_opts
+        self.num_classes = num_classes
+        self.thresholds = sorted({_threshold(m) for m in metrics_opts.values()}, key=str)
+        # (threshold, [true positives, predicted positives, actual positives], class)
+        self.counts = torch.zeros(len(self.thresholds), 3, num_classes, dtype=torch.long, device=device)
+        self.n = torch.zeros((), dtype=torch.long, device=device)
+
+    def update(self, pred, true):
+        """Add a batch to the counts
+
+        Args:
+            pred(torch.Tensor): (N, H, W, K) segmented predictions, e.g., from
+              Framework.segment
+            true(torch.Tensor): (N, H, W, K) masks, or (N, H, W) class index maps
+        """
+        true = true.to(self.counts.device)
+        if true.ndim == 3:
+            true = torch.nn.functional.one_hot(true.long(), self.num_classes)
+        true = true == 1
+        pred = pred.to(self.counts.device)
+
+        dims = [0, 1, 2]
+        self.counts[:, 2] += true.sum(dim=dims)
+        for i, threshold in enumerate(self.thresholds):
+            positive = pred == 1 if threshold is None else pred > threshold
+            self.counts[i, 0] += (positive & true).sum(dim=dims)
+            self.counts[i, 1] += positive.sum(dim=dims)
+        self.n += true.shape[0] * true.shape[1] * true.shape[2]
+
+    def compute(self):
+        """The metrics over all the batches added so far
+
+        Return:
+            A dictionary from the metric names to (K,) cpu tensors
+        """
+        counts, n = self.counts.cpu(), self.n.cpu()
+        results = {}
+        for k, metric in self.metrics_opts.items():
+            tp, pred_pos, true_pos = counts[self.thresholds.index(_threshold(metric))]
+            fp, fn = pred_pos - tp, true_pos - tp
+            results[k] = POOLED_METRICS[k](tp, fp, fn, n - tp - fp - fn)
+        return results
+
+    def reset(self):
+        """Clear the counts, e.g., at the start of an epoch"""
+        self.counts.zero_()
+        self.n.zero_()
+
+
+def _threshold(metric_opts):
+    return (metric_opts or {}).get("threshold")
+
+
+def _zero_if_empty(tp, other):
+    result = torch.true_divide(tp, tp + other)
+    result[(tp == other) & (other == 0)] = 0
+    return result
+
+
+# metrics from pooled tp, fp, fn, tn, matching the per-batch functions above
+POOLED_METRICS = {
+    "precision": lambda tp, fp, fn, tn: _zero_if_empty(tp, fp),
+    "recall": lambda tp, fp, fn, tn: _zero_if_empty(tp, fn),
+    "pixel_acc": lambda tp, fp, fn, tn: torch.true_divide(tp + tn, tp + fp + fn + tn),
+    "dice": lambda tp, fp, fn, tn: torch.true_divide(2 * tp, 2 * tp + fp + fn),
+    "IoU": lambda tp, fp, fn, tn: torch.true_divide(tp, tp + fp + fn),
+}
@@ -19,9 +19,10 @@ import numpy as np
 import pandas as pd
 from torchvision.utils import make_grid
 import torch
+from glacier_mapping.models.metrics import ConfusionMatrix
 
 
-def train_epoch(loader, frame, metrics_opts):
+def train_epoch(loader, frame, metrics_opts, augment=None):
     """Train model for one epoch
 
     This makes one pass through a dataloader and updates the model in the
@@ -36,23 +37,24 @@ def train_epoch(loader, frame, metrics_opts):
     :param metrics_opts: A dictionary whose keys specify which metrics to
       compute on the predictions from the model.
     :type metrics_opts: dict
+    :param augment: An optional augmentation, applied to each batch on the
+      frame's device before the gradient step.
+    :type augment: BatchAugment
     :return (train_loss, metrics): A tuple containing the average epoch loss
-      and the metrics on the training set.
+      and the metrics on the training set, pooled over all its pixels.
     """
-    loss, metrics = 0, {}
+    loss = 0
+    confusion = ConfusionMatrix(metrics_opts, frame.num_classes, frame.device)
     frame.model.train()
     for x, y in loader:
+        if augment is not None:
+            x, y = augment(x.to(frame.device), y.to(frame.device))
         y_hat, _loss = frame.optimize(x, y)
         loss += _loss
 
-        y_hat = frame.segment(y_hat)
-        metrics_ = frame.metrics(y_hat, y, metrics_opts)
+        confusion.update(frame.segment(y_hat), y)
 
-        update_metrics(metrics, metrics_)
-
-    agg_metrics(metrics)
-
-    return loss / len(loader.dataset), metrics
+    return loss / len(loader.dataset), confusion.compute()
 
 
 def validate(loader, frame, metrics_opts):
@@ -72,23 +74,19 @@ def validate(loader, frame, metrics_opts):
       compute on the predictions from the model.
     :type metrics_opts: dict
     :return (val_loss, metrics): A tuple containing the average validation loss
-      and the metrics on the validation set.
+      and the metrics on the validation set, pooled over all its pixels.
     """
-    loss, metrics = 0, {}
-    channel_first = lambda x: x.permute(0, 3, 1, 2)
+    loss = 0
+    confusion = ConfusionMatrix(metrics_opts, frame.num_classes, frame.device)
     frame.model.eval()
     for x, y in loader:
         with torch.no_grad():
-            y_hat = frame.infer(x)
-            loss += frame.calc_loss(channel_first(y_hat), channel_first(y)).item()
-
-            y_hat = frame.segment(y_hat)
-            metrics_ = frame.metrics(y_hat, y, metrics_opts)
+            y_hat, _loss = frame.evaluate(x, y)
+            loss += _loss
 
-            update_metrics(metrics, metrics_)
+            confusion.update(frame.segment(y_hat), y)
 
-    agg_metrics(metrics)
-    return loss / len(loader.dataset), metrics
+    return loss / len(loader.dataset), confusion.compute()
 
 
 def log_batch(epoch, n_epochs, i, n, loss, batch_size):
@@ -153,6 +151,8 @@ def log_images(writer, frame, batch, epoch, stage="train"):
     squash = lambda x: (x - x.min()) / (x.max() - x.min())
 
     x, y = batch
+    if y.ndim == 3:
+        y = torch.nn.functional.one_hot(y.long(), frame.num_classes).float()
 
     y_hat = frame.act(frame.infer(x))
     y = torch.flatten(y.permute(0, 1, 3, 2), start_dim=2)
@@ -162,23 +162,3 @@ def log_images(writer, frame, batch, epoch, stage="train"):
         writer.add_image(f"{stage}/x", make_grid(pm(squash(x[:, :, :, :3]))), epoch)
         writer.add_image(f"{stage}/y", make_grid(y.unsqueeze(1)), epoch)
     writer.add_image(f"{stage}/y_hat", make_grid(y_hat.unsqueeze(1)), epoch)
-
-def update_metrics(main_metrics, batch_metrics):
-    """Append --inplace-- a dict of tensors to another element by element
-       Args:
-            main_metrics (dict(troch.Tensor)): the matrix to append to
-            batch_metrics (dict(troch.Tensor)): the new value to append to main_metrics
-    """
-    for k, v in batch_metrics.items():
-        if k in main_metrics:
-            main_metrics[k] = torch.cat((main_metrics[k], v.unsqueeze(-1)), 1)
-        else:
-            main_metrics[k] = v.unsqueeze(-1)
-
-def agg_metrics(metrics):
-    """Aggregate --inplace-- the mean of a matrix of tensor (across rows)
-       Args:
-            metrics (dict(troch.Tensor)): the matrix to get mean of"""
-    for k, v in metrics.items():
-        metrics[k] = metrics[k].mean(1)
-        metrics[k] = metrics[k].data.cpu()
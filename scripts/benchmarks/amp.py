@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""
+Benchmark mixed precision training and inference
+
+Trains the model of the training configuration on a synthetic dataset, once
+in float32 and once under autocast in each requested dtype, from the same
+initialization and batches. Reports the time per optimize step and per
+inference batch, and the validation IoU of each class, as differences from
+float32.
+
+python3 -m scripts.benchmarks.amp -c conf/train.yaml -b 4 -s 128 -n 100
+"""
+import argparse
+import time
+from addict import Dict
+import numpy as np
+import torch
+import yaml
+from torch.utils.data import DataLoader, TensorDataset
+from glacier_mapping.models.frame import Framework
+import glacier_mapping.train as tr
+
+
+def synthetic_data(n, size, inchannels, outchannels, seed):
+    """Images whose class is given by the largest of the first channels, blurred"""
+    generator = torch.Generator().manual_seed(seed)
+    x = torch.randn(n, size, size, inchannels, generator=generator)
+    x[..., :outchannels] = torch.nn.functional.avg_pool2d(
+        x[..., :outchannels].permute(0, 3, 1, 2), 5, stride=1, padding=2
+    ).permute(0, 2, 3, 1)
+    y = x[..., :outchannels].argmax(-1).to(torch.uint8)
+    return x, y
+
+
+def run(conf, dtype, train, val, batch_size, seed):
+    torch.manual_seed(seed)
+    amp_opts = {"enabled": dtype is not None, "dtype": dtype}
+    frame = Framework(model_opts=conf.model_opts, optimizer_opts=conf.optim_opts,
+                      reg_opts=conf.reg_opts, amp_opts=amp_opts)
+
+    step_times = []
+    frame.model.train()
+    for x, y in DataLoader(train, batch_size=batch_size):
+        start = time.perf_counter()
+        frame.optimize(x, y)
+        step_times.append(time.perf_counter() - start)
+
+    val_loader = DataLoader(val, batch_size=batch_size)
+    start = time.perf_counter()
+    _, metrics = tr.validate(val_loader, frame, conf.metrics_opts)
+    infer_time = (time.perf_counter() - start) / len(val_loader)
+    # the first steps include allocations and kernel selection
+    return np.median(step_times[2:]), infer_time, metrics["IoU"]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark mixed precision")
+    parser.add_argument("-c", "--train_yaml", type=str, default="conf/train.yaml")
+    parser.add_argument("-b", "--batch_size", type=int, default=4)
+    parser.add_argument("-s", "--size", type=int, default=128)
+    parser.add_argument("-n", "--n_batches", type=int, default=100)
+    parser.add_argument("--lr", type=float, default=1e-3, help="overrides the configured learning rate, to learn the synthetic task in a few steps")
+    parser.add_argument("--dtypes", type=str, nargs="+", default=["bfloat16"])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    conf = Dict(yaml.safe_load(open(args.train_yaml, "r")))
+    conf.metrics_opts = {"IoU": {"threshold": 0.4}}
+    conf.optim_opts.args.lr = args.lr
+    model_args = conf.model_opts.args
+    train = TensorDataset(*synthetic_data(
+        args.n_batches * args.batch_size, args.size, model_args.inchannels,
+        model_args.outchannels, args.seed
+    ))
+    val = TensorDataset(*synthetic_data(
+        4 * args.batch_size, args.size, model_args.inchannels,
+        model_args.outchannels, args.seed + 1
+    ))
+
+    results = {None: run(conf, None, train, val, args.batch_size, args.seed)}
+    for dtype in args.dtypes:
+        results[dtype] = run(conf, dtype, train, val, args.batch_size, args.seed)
+
+    step32, infer32, iou32 = results[None]
+    print(f"{conf.model_opts.name}, {args.n_batches} batches of "
+          f"{(args.batch_size, args.size, args.size, model_args.inchannels)} on {torch.get_num_threads()} threads")
+    for dtype, (step, infer, iou) in results.items():
+        print(f"{dtype or 'float32'}: step: {1e3 * step:.0f}ms ({step32 / step:.2f}x) | "
+              f"inference: {1e3 * infer:.0f}ms ({infer32 / infer:.2f}x) | "
+              f"IoU: {' '.join(f'{v:.3f}' for v in iou.tolist())} "
+              f"(delta: {' '.join(f'{v:+.3f}' for v in (iou - iou32).tolist())})")
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""
+Benchmark batch augmentation against the training step
+
+Times BatchAugment on a synthetic batch, and compares it to one
+Framework.optimize step of the model in the training configuration, on
+the same batch. Also checks that images and labels are transformed
+together.
+
+python3 -m scripts.benchmarks.augment -c conf/train.yaml -b 8 -s 256
+"""
+import argparse
+import time
+from addict import Dict
+import torch
+import yaml
+from glacier_mapping.data.augment import BatchAugment
+from glacier_mapping.models.frame import Framework
+
+
+def timeit(f, repeats=5):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        f()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark batch augmentation")
+    parser.add_argument("-c", "--train_yaml", type=str, default="conf/train.yaml")
+    parser.add_argument("-b", "--batch_size", type=int, default=8)
+    parser.add_argument("-s", "--size", type=int, default=256)
+    parser.add_argument("-r", "--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    conf = Dict(yaml.safe_load(open(args.train_yaml, "r")))
+    frame = Framework(
+        model_opts=conf.model_opts,
+        optimizer_opts=conf.optim_opts,
+        reg_opts=conf.reg_opts,
+    )
+    shape = (args.batch_size, args.size, args.size)
+    x = torch.randn(shape + (conf.model_opts.args.inchannels,), device=frame.device)
+    labels = torch.randint(0, conf.model_opts.args.outchannels, shape, device=frame.device)
+    y = torch.nn.functional.one_hot(labels, conf.model_opts.args.outchannels).float()
+
+    # the label of a pixel follows it, wherever augmentation moves it
+    augment_opts = {k: v for k, v in conf.augment_opts.items() if k != "enabled"}
+    augment = BatchAugment(**{**augment_opts, "brightness": 0})
+    x_aug, y_aug = augment(y.clone(), y.clone())
+    assert torch.equal(x_aug, y_aug)
+
+    augment = BatchAugment(**augment_opts)
+    t_augment = timeit(lambda: augment(x, y), args.repeats)
+    t_step = timeit(lambda: frame.optimize(x, y), args.repeats)
+
+    print(f"batch: {tuple(x.shape)} on {frame.device}")
+    print(f"augment: {1e3 * t_augment:.2f}ms | optimize: {1e3 * t_step:.2f}ms "
+          f"| augment / optimize: {100 * t_augment / t_step:.2f}%")
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+Benchmark reading a subset of the image channels
+
+Writes the same synthetic slices with the channels along the last axis, as
+usual, and channel major, then times one epoch through a memory mapped
+GlacierDataset that reads all the channels, and one that reads only
+img_channels. The files are evicted from the page cache before each epoch
+where the platform supports it, so reads come from disk.
+
+python3 -m scripts.benchmarks.channel_reads -n 200 -c 15 --img_channels 2 4 6
+"""
+import argparse
+import shutil
+import tempfile
+import time
+from pathlib import Path
+import numpy as np
+from glacier_mapping.data.data import GlacierDataset
+from glacier_mapping.data.storage import make_encoding
+from scripts.benchmarks.compact_slices import drop_cache, write_dataset
+
+
+def epoch_time(folder, img_channels=None):
+    drop_cache(folder)
+    dataset = GlacierDataset(folder, mmap_mode="r", img_channels=img_channels)
+    start = time.perf_counter()
+    for i in range(len(dataset)):
+        dataset[i]
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark channel selective reads")
+    parser.add_argument("-n", "--n_slices", type=int, default=200)
+    parser.add_argument("-s", "--size", type=int, default=512)
+    parser.add_argument("-c", "--channels", type=int, default=15)
+    parser.add_argument("--img_channels", type=int, nargs="+", default=[2, 4, 6])
+    parser.add_argument("-o", "--out_dir", type=str, default=None)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    shape = (args.size, args.size)
+    imgs = [rng.normal(size=shape + (args.channels,)).astype(np.float32) for _ in range(args.n_slices)]
+    masks = [rng.integers(0, 2, shape + (2,), dtype=np.uint8) for _ in range(args.n_slices)]
+    layouts = {
+        "(H, W, C)": None,
+        "(C, H, W)": make_encoding(channel_major=True),
+    }
+
+    out_dir = Path(args.out_dir or tempfile.mkdtemp())
+    try:
+        folders = {}
+        for k, (name, encoding) in enumerate(layouts.items()):
+            folders[name] = out_dir / f"layout_{k}"
+            write_dataset(folders[name], imgs, masks, encoding)
+
+        # both layouts decode to the same slices
+        x0 = GlacierDataset(folders["(H, W, C)"], img_channels=args.img_channels)[0][0]
+        x1 = GlacierDataset(folders["(C, H, W)"], img_channels=args.img_channels)[0][0]
+        assert x0.equal(x1) and x0.shape[-1] == len(args.img_channels)
+
+        print(f"slices: {args.n_slices} x {shape + (args.channels,)}, "
+              f"reading channels {args.img_channels}")
+        base = epoch_time(folders["(H, W, C)"])
+        for name, folder in folders.items():
+            t_all, t_some = epoch_time(folder), epoch_time(folder, args.img_channels)
+            print(f"{name}: all channels: {t_all:.2f}s | img_channels: {t_some:.2f}s "
+                  f"({base / t_some:.1f}x faster than all channels of (H, W, C))")
+    finally:
+        if args.out_dir is None:
+            shutil.rmtree(out_dir)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""
+Benchmark the channels_last memory format
+
+Times Framework.optimize and Framework.evaluate on (N, H, W, C) batches, as
+the loaders produce them, with the model in the default contiguous memory
+format and in channels_last. Both models start from the same weights, and
+their predictions are checked to agree.
+
+python3 -m scripts.benchmarks.channels_last -c conf/train.yaml -b 4 -s 256
+"""
+import argparse
+import time
+from addict import Dict
+import torch
+import yaml
+from glacier_mapping.models.frame import Framework
+
+
+def timeit(f, repeats=5):
+    f()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        f()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark channels_last")
+    parser.add_argument("-c", "--train_yaml", type=str, default="conf/train.yaml")
+    parser.add_argument("-b", "--batch_size", type=int, default=4)
+    parser.add_argument("-s", "--size", type=int, default=256)
+    parser.add_argument("-r", "--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    conf = Dict(yaml.safe_load(open(args.train_yaml, "r")))
+    shape = (args.batch_size, args.size, args.size)
+    x = torch.randn(shape + (conf.model_opts.args.inchannels,))
+    y = torch.randint(0, conf.model_opts.args.outchannels, shape, dtype=torch.uint8)
+
+    results, state = {}, None
+    for channels_last in [False, True]:
+        conf.model_opts.channels_last = channels_last
+        torch.manual_seed(0)
+        frame = Framework(model_opts=conf.model_opts, optimizer_opts=conf.optim_opts,
+                          reg_opts=conf.reg_opts, amp_opts=conf.amp_opts)
+        if state is None:
+            state = {k: v.clone() for k, v in frame.model.state_dict().items()}
+        frame.model.load_state_dict(state)
+
+        frame.model.eval()
+        y_hat, _ = frame.evaluate(x, y)
+        t_evaluate = timeit(lambda: frame.evaluate(x, y), args.repeats)
+        frame.model.train()
+        t_optimize = timeit(lambda: frame.optimize(x, y), args.repeats)
+        view = frame.channel_first(x).data_ptr() == x.to(frame.device).data_ptr()
+        results[channels_last] = (t_optimize, t_evaluate, y_hat, view)
+
+    assert torch.allclose(results[False][2], results[True][2], atol=1e-3)
+    base_optimize, base_evaluate = results[False][:2]
+    print(f"batch: {tuple(x.shape)} on {torch.get_num_threads()} threads, amp: {dict(conf.amp_opts)}")
+    for channels_last, (t_optimize, t_evaluate, _, view) in results.items():
+        print(f"{'channels_last' if channels_last else 'contiguous'}: "
+              f"optimize: {1e3 * t_optimize:.0f}ms ({base_optimize / t_optimize:.2f}x) | "
+              f"evaluate: {1e3 * t_evaluate:.0f}ms ({base_evaluate / t_evaluate:.2f}x) | "
+              f"input copied: {not view}")
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+Benchmark compact slice storage
+
+Writes the same synthetic slices as float32 images and uint8 masks, and
+with compact encodings (float16 or uint16 images, bit packed masks), then
+reports each dataset's size on disk and the time for one epoch through
+GlacierDataset. The files are evicted from the page cache before each epoch
+where the platform supports it, so reads come from disk.
+
+python3 -m scripts.benchmarks.compact_slices -n 200 -c 15
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+import numpy as np
+from glacier_mapping.data.data import GlacierDataset
+from glacier_mapping.data.storage import encode_slice, make_encoding, write_encoding
+
+
+def write_dataset(out_dir, imgs, masks, encoding):
+    os.makedirs(out_dir)
+    if encoding is not None:
+        write_encoding(out_dir, encoding)
+    for k, (img, mask) in enumerate(zip(imgs, masks)):
+        img, mask = encode_slice(img, mask, encoding)
+        np.save(Path(out_dir, f"slice_0_img_{k:03}.npy"), img)
+        np.save(Path(out_dir, f"slice_0_mask_{k:03}.npy"), mask)
+
+
+def drop_cache(folder):
+    if not hasattr(os, "posix_fadvise"):
+        return
+    for path in Path(folder).iterdir():
+        fd = os.open(path, os.O_RDONLY)
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        os.close(fd)
+
+
+def epoch_time(folder):
+    drop_cache(folder)
+    dataset = GlacierDataset(folder)
+    start = time.perf_counter()
+    for i in range(len(dataset)):
+        dataset[i]
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark compact slice storage")
+    parser.add_argument("-n", "--n_slices", type=int, default=200)
+    parser.add_argument("-s", "--size", type=int, default=512)
+    parser.add_argument("-c", "--channels", type=int, default=15)
+    parser.add_argument("-k", "--mask_channels", type=int, default=3)
+    parser.add_argument("-o", "--out_dir", type=str, default=None)
+    args = parser.parse_args()
+
+    # raw bands are 16 bit integers, with NaN outside the border
+    rng = np.random.default_rng(0)
+    shape = (args.size, args.size)
+    imgs, masks = [], []
+    for _ in range(args.n_slices):
+        img = rng.integers(0, 20000, shape + (args.channels,)).astype(np.float32)
+        img[: args.size // 8] = np.nan
+        labels = rng.integers(0, args.mask_channels, shape)
+        imgs.append(img)
+        masks.append(np.eye(args.mask_channels, dtype=np.uint8)[labels])
+
+    mask_shape = masks[0].shape
+    encodings = {
+        "float32 / uint8": None,
+        "float16 / packbits": make_encoding("float16", pack_masks=True, mask_shape=mask_shape),
+        "uint16 / packbits": make_encoding("uint16", pack_masks=True, mask_shape=mask_shape),
+    }
+
+    out_dir = Path(args.out_dir or tempfile.mkdtemp())
+    try:
+        results = {}
+        for name, encoding in encodings.items():
+            folder = out_dir / name.replace(" / ", "_")
+            write_dataset(folder, imgs, masks, encoding)
+            size = sum(p.stat().st_size for p in folder.iterdir())
+            results[name] = (size, epoch_time(folder))
+
+        base_size, base_time = results["float32 / uint8"]
+        print(f"slices: {args.n_slices} x {shape + (args.channels,)}")
+        for name, (size, t) in results.items():
+            print(f"{name}: {size / 1e6:.1f} MB ({base_size / size:.1f}x smaller) | "
+                  f"epoch: {t:.2f}s ({base_time / t:.1f}x faster)")
+    finally:
+        if args.out_dir is None:
+            shutil.rmtree(out_dir)
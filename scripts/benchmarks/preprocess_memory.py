@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""
+Peak memory of the scene-level preprocessing functions
+
+Runs slice_pair, clip_image_ and add_bg_channel on a synthetic scene, and
+checks with tracemalloc that none of them allocates scene-sized temporaries
+beyond its output. Exits with an error if any of them does.
+
+python3 -m scripts.benchmarks.preprocess_memory -s 16384 -c 15
+"""
+import argparse
+import sys
+import tracemalloc
+import numpy as np
+from glacier_mapping.data.process_slices_funs import add_bg_channel
+from glacier_mapping.data.slice import clip_image_, slice_pair
+
+
+def peak_allocation(f, *args, **kwargs):
+    """Peak bytes allocated while running f, beyond what existed before"""
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    f(*args, **kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Peak memory of preprocessing functions")
+    parser.add_argument("-s", "--scene_size", type=int, default=8192)
+    parser.add_argument("-c", "--channels", type=int, default=15)
+    parser.add_argument("-k", "--mask_channels", type=int, default=3)
+    args = parser.parse_args()
+
+    size = (args.scene_size, args.scene_size)
+    img = np.ones(size + (args.channels,), dtype=np.float32)
+    img[: size[0] // 4] = np.nan
+    mask = np.ones(size + (args.mask_channels,), dtype=np.uint8)
+    border = np.ones(size + (1,), dtype=np.uint8)
+    border[:, : size[1] // 4] = 0
+
+    # the budget is a few single-channel (H, W) temporaries, never a copy of
+    # the whole image or mask
+    pixels = size[0] * size[1]
+    checks = {
+        "slice_pair": (peak_allocation(slice_pair, img, mask), 2 * pixels),
+        "clip_image_": (peak_allocation(clip_image_, img, border), 2 * pixels),
+        "add_bg_channel": (
+            peak_allocation(add_bg_channel, img, mask),
+            mask.nbytes + mask.nbytes // args.mask_channels + 2 * pixels
+        ),
+    }
+
+    print(f"scene: {img.nbytes / 1e9:.2f} GB image, {mask.nbytes / 1e9:.2f} GB mask")
+    failed = False
+    for name, (peak, budget) in checks.items():
+        status = "ok" if peak <= budget else "REGRESSION"
+        failed |= peak > budget
+        print(f"{name}: peak {peak / 1e6:.1f} MB (budget {budget / 1e6:.1f} MB) {status}")
+
+    sys.exit(int(failed))
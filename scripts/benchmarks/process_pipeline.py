@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""
+Benchmark the postprocessing of slices
+
+Compares ProcessPipeline, which compiles process_funs once, against the
+earlier path that resolved every function by name, re-read the statistics
+json, and normalized channel by channel for every tile. Both are run on the
+same synthetic slices, and their outputs are checked to agree.
+
+python3 -m scripts.benchmarks.process_pipeline -n 64 -c 15
+"""
+import argparse
+import json
+import tempfile
+import time
+import numpy as np
+from glacier_mapping.data.process_slices_funs import ProcessPipeline, add_bg_channel
+
+
+def legacy_postprocess(img, mask, process_funs):
+    """The per-tile implementation ProcessPipeline replaced"""
+    for fun_name, fun_args in process_funs.items():
+        if fun_name == "impute":
+            img = np.nan_to_num(img, nan=fun_args["value"])
+        elif fun_name == "normalize":
+            stats = json.load(open(fun_args["stats_path"], "r"))
+            for i in range(img.shape[2]):
+                img[:, :, i] -= stats["means"][i]
+                if stats["stds"][i] > 0:
+                    img[:, :, i] /= stats["stds"][i]
+                else:
+                    img[:, :, i] = 0
+        elif fun_name == "extract_channel":
+            img = img[:, :, fun_args["img_channels"]]
+            mask = mask[:, :, fun_args["mask_channels"]]
+        elif fun_name == "add_bg_channel":
+            img, mask = add_bg_channel(img, mask)
+    return img, mask
+
+
+def timeit(f, repeats=3):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = f()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark slice postprocessing")
+    parser.add_argument("-n", "--n_slices", type=int, default=64)
+    parser.add_argument("-s", "--size", type=int, default=512)
+    parser.add_argument("-c", "--channels", type=int, default=15)
+    parser.add_argument("-r", "--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    shape = (args.n_slices, args.size, args.size, args.channels)
+    imgs = rng.normal(1000, 100, shape).astype(np.float32)
+    imgs[rng.random(shape[:-1]) < 0.1] = np.nan
+    masks = (rng.random(shape[:-1] + (3,)) < 0.3).astype(np.uint8)
+
+    stats_file = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+    stds = [100.0] * args.channels
+    stds[-1] = 0
+    json.dump({"means": [1000.0] * args.channels, "stds": stds}, stats_file)
+    stats_file.close()
+
+    process_funs = {
+        "impute": {"value": 0},
+        "normalize": {"stats_path": stats_file.name},
+        "extract_channel": {
+            "mask_channels": [1, 2],
+            "img_channels": list(range(0, args.channels, 2)),
+        },
+        "add_bg_channel": {},
+    }
+
+    t_legacy, legacy = timeit(
+        lambda: [legacy_postprocess(img, mask, process_funs) for img, mask in zip(imgs, masks)],
+        args.repeats
+    )
+    pipeline = ProcessPipeline(process_funs)
+    t_tiles, tiles = timeit(
+        lambda: [pipeline(img, mask) for img, mask in zip(imgs, masks)],
+        args.repeats
+    )
+    t_batch, batch = timeit(lambda: pipeline(imgs, masks), args.repeats)
+
+    for (x0, y0), (x1, y1) in zip(legacy, tiles):
+        assert np.allclose(x0, x1, atol=1e-5) and np.array_equal(y0, y1)
+    assert np.allclose(np.stack([x for x, _ in legacy]), batch[0], atol=1e-5)
+    assert np.array_equal(np.stack([y for _, y in legacy]), batch[1])
+
+    print(f"slices: {shape}")
+    print(f"legacy: {t_legacy:.3f}s | pipeline per tile: {t_tiles:.3f}s "
+          f"({t_legacy / t_tiles:.1f}x) | pipeline batch: {t_batch:.3f}s "
+          f"({t_legacy / t_batch:.1f}x)")
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+Benchmark slice footprint generation
+
+Compares the vectorized slice_polys against the earlier loop over
+shapely.geometry.box, on the metadata of a large synthetic scene.
+
+python3 -m scripts.benchmarks.slice_polys -s 60000
+"""
+import argparse
+import time
+from types import SimpleNamespace
+from geopandas.geodataframe import GeoDataFrame
+from rasterio.coords import BoundingBox
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+import numpy as np
+import shapely.geometry
+from glacier_mapping.data.slice import slice_polys
+
+
+def loop_slice_polys(imgf, size=(512, 512), overlap=6):
+    """The nested loop implementation slice_polys replaced"""
+    ix_row = np.arange(0, imgf.meta["height"], size[0] - overlap)
+    ix_col = np.arange(0, imgf.meta["width"], size[1] - overlap)
+    lats = np.linspace(imgf.bounds.bottom, imgf.bounds.top, imgf.meta["height"])
+    longs = np.linspace(imgf.bounds.left, imgf.bounds.right, imgf.meta["width"])
+
+    polys = []
+    for i in range(len(ix_row) - 1):
+        for j in range(len(ix_col) - 1):
+            box = shapely.geometry.box(
+                longs[ix_col[j]],
+                lats[ix_row[i]],
+                longs[ix_col[j + 1]],
+                lats[ix_row[i + 1]],
+            )
+            polys.append(box)
+
+    return GeoDataFrame(geometry=polys, crs=imgf.meta["crs"].to_string())
+
+
+def fake_raster(height, width, res=30):
+    """The subset of a rasterio dataset used by slice_polys"""
+    transform = from_origin(300000, 3100000, res, res)
+    bounds = BoundingBox(
+        transform.c, transform.f - res * height, transform.c + res * width, transform.f
+    )
+    meta = {"height": height, "width": width, "crs": CRS.from_epsg(32645)}
+    return SimpleNamespace(meta=meta, transform=transform, bounds=bounds)
+
+
+def timeit(f, *args, repeats=3):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = f(*args)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark slice footprint generation")
+    parser.add_argument("-s", "--scene_size", type=int, default=60000)
+    parser.add_argument("-r", "--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    imgf = fake_raster(args.scene_size, args.scene_size)
+    t_loop, loop_polys = timeit(loop_slice_polys, imgf, repeats=args.repeats)
+    t_vec, vec_polys = timeit(slice_polys, imgf, repeats=args.repeats)
+
+    print(f"tiles: {len(vec_polys)} (loop produced {len(loop_polys)})")
+    print(f"loop: {t_loop:.3f}s | vectorized: {t_vec:.3f}s | speedup: {t_loop / t_vec:.1f}x")
@@ -6,6 +6,8 @@ import json
 from addict import Dict
 import torch
 
+from glacier_mapping.data.augment import BatchAugment
+from glacier_mapping.data.cache import TensorCache
 from glacier_mapping.data.data import fetch_loaders
 from glacier_mapping.models.frame import Framework
 from glacier_mapping.models.metrics import diceloss
@@ -17,19 +19,24 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Preprocess raw tiffs into slices")
     parser.add_argument("-d", "--data_dir", type=str)
     parser.add_argument("-c", "--train_yaml", type=str)
-    parser.add_argument("-p", "--postprocess_conf", type=str, default = "conf/process_geo.conf")
+    parser.add_argument("-p", "--postprocess_conf", type=str, default="conf/postprocess.yaml")
     parser.add_argument("-b", "--batch_size", type=int, default = 16)
     parser.add_argument("-r", "--run_name", type=str, default="demo")
     parser.add_argument("-e", "--epochs", type=int, default=200)
     parser.add_argument("-s", "--save_every", type=int, default=50)
     parser.add_argument("-l", "--loss_type", type=str, default="dice")
     parser.add_argument("--device", type=str, default=None)
+    parser.add_argument("--cache_dir", type=str, default=None,
+                        help="postprocess raw slices in data_dir with the postprocess_conf process_funs, through a cache in this directory")
+    parser.add_argument("--cache_budget", type=float, default=None, help="maximum size of the cache, in GB")
     args = parser.parse_args()
 
     data_dir = pathlib.Path(args.data_dir)
     conf = Dict(yaml.safe_load(open(args.train_yaml, "r")))
     loss_type = args.loss_type
     device = args.device
+    cache_dir, cache_budget = args.cache_dir, args.cache_budget
+    postprocess_conf = args.postprocess_conf
     if device is not None:
         device = torch.device(device)
 
@@ -42,13 +49,26 @@ if __name__ == '__main__':
         "save_every": args.save_every
     })
 
-    loaders = fetch_loaders(data_dir, args.batch_size, shuffle=True)
+    cache, process_funs = None, None
+    if cache_dir is not None:
+        budget = None if cache_budget is None else cache_budget * 1e9
+        cache = TensorCache(cache_dir, budget)
+        process_funs = Dict(yaml.safe_load(open(postprocess_conf, "r"))).process_funs
+
+    loaders = fetch_loaders(data_dir, args.batch_size, shuffle=True,
+                            cache=cache, process_funs=process_funs,
+                            dataset_opts=conf.dataset_opts,
+                            loader_opts=conf.loader_opts)
 
     # TODO:handle this error better
     # if input mask dimension different than outchannels
     outchannels = conf.model_opts.args.outchannels
-    y_channels = [y.shape[-1] for _, y in loaders["val"]][0]
-    if y_channels != outchannels:
+    _, y = next(iter(loaders["val"]))
+    if y.ndim == 3:
+        # class index maps
+        if y.max() >= outchannels:
+            raise ValueError("Class indices exceed the model outchannels.")
+    elif y.shape[-1] != outchannels:
         raise ValueError("Output dimension is different from model outchannels.")
 
     # TODO: try to have less nested if/else
@@ -68,9 +88,14 @@ if __name__ == '__main__':
         optimizer_opts=conf.optim_opts,
         reg_opts=conf.reg_opts,
         loss_fn=loss_fn,
-        device=device
+        device=device,
+        amp_opts=conf.amp_opts
     )
 
+    augment = None
+    if conf.augment_opts.enabled:
+        augment = BatchAugment(**{k: v for k, v in conf.augment_opts.items() if k != "enabled"})
+
     # Setup logging
     writer = SummaryWriter(f"{data_dir}/runs/{args.run_name}/logs/")
     writer.add_text("Arguments", json.dumps(vars(args)))
@@ -82,7 +107,7 @@ if __name__ == '__main__':
 
         # train loop
         loss_d = {}
-        loss_d["train"], metrics = tr.train_epoch(loaders["train"], frame, conf.metrics_opts)
+        loss_d["train"], metrics = tr.train_epoch(loaders["train"], frame, conf.metrics_opts, augment)
         tr.log_metrics(writer, metrics, loss_d["train"], epoch, mask_names=mask_names)
         if (epoch+1) % args.save_every == 0:
             tr.log_images(writer, frame, next(iter(loaders["train"])), epoch)
@@ -94,6 +119,11 @@ if __name__ == '__main__':
         if (epoch+1) % args.save_every == 0:
             tr.log_images(writer, frame, next(iter(loaders["val"])), epoch, "val")
 
+        for split in ["train", "val"]:
+            sample_cache = loaders[split].dataset.cache
+            if sample_cache is not None:
+                writer.add_scalars(f"SampleCache/{split}", sample_cache.stats(), epoch)
+
         # Save model
         writer.add_scalars("Loss", loss_d, epoch)
         if (epoch+1) % args.save_every == 0: